@@ -1,3 +1,4 @@
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
 
@@ -5,6 +6,92 @@ class Settings(BaseSettings):
     bot_token: str
     database_url: str
 
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    # asyncpg prepared statement cache per connection, 0 disables it (pgbouncer)
+    db_statement_cache_size: int = 100
+    # apply migrations/NNN_*.sql on startup
+    run_migrations: bool = True
+
+    # safety net for missed NOTIFYs; changes normally arrive via LISTEN
+    settings_cache_ttl: float = 60.0
+    catalog_cache_ttl: float = 300.0
+
+    scheduler_jitter: float = 5.0
+    referral_settle_interval: float = 60.0
+    referral_settle_batch: int = 500
+    server_load_reconcile_interval: float = 600.0
+
+    # keep hot tg_sessions rows in memory and flush navigation writes in batches.
+    # Unset means on for polling (one process) and off for webhook mode: replicas
+    # behind a load balancer would each cache the same user. Enable it there only
+    # with per-user sticky routing.
+    session_write_back: bool | None = None
+    session_store_capacity: int = 10000
+    session_store_ttl: float = 30.0
+    session_flush_interval: float = 1.0
+    # tg_users.last_seen_at is buffered and written in one UPDATE per interval
+    last_seen_flush_interval: float = 5.0
+
+    # logs rows are queued in memory and inserted in batches
+    log_queue_capacity: int = 10000
+    log_flush_interval: float = 1.0
+    log_flush_batch: int = 1000
+
+    # payment proof files, content-addressed by SHA-256
+    blob_store_path: str = "data/blobs"
+    proof_max_bytes: int = 10 * 1024 * 1024
+    proof_mime_types: list[str] = ["image/jpeg", "image/png", "image/webp", "application/pdf"]
+    proof_download_timeout: int = 60
+    # re-encode image proofs (needs Pillow) and keep a thumbnail for admin previews
+    proof_normalize_images: bool = True
+    proof_keep_originals: bool = False
+    proof_image_max_side: int = 1600
+    proof_image_quality: int = 80
+    proof_thumb_side: int = 320
+    proof_thumb_quality: int = 70
+    proof_image_workers: int = 2
+    # larger images are stored as uploaded instead of being decoded (~3 bytes per pixel per worker)
+    proof_image_max_pixels: int = 25_000_000
+    # dHash bit distance still flagged as the same image; the band index guarantees up to 3
+    proof_duplicate_distance: int = 3
+    # bank statement import: matched top-ups committed (and users notified) per batch
+    statement_batch_size: int = 100
+    statement_download_timeout: int = 300
+    # seconds an admin's claim on a moderation item holds before others can take it
+    moderation_claim_ttl: int = 600
+
+    # skip the edit attempt for screens older than this (seconds); 0 always tries
+    # it and only sends a new message when Telegram refuses
+    screen_edit_window: int = 0
+
+    # Bot API send limits (messages per second)
+    outbound_global_rate: float = 30.0
+    outbound_chat_rate: float = 1.0
+    outbound_group_rate: float = 20 / 60
+    outbound_chat_burst: float = 5.0
+    outbound_chat_buckets: int = 10000
+    outbound_max_retries: int = 3
+
+    # "polling" or "webhook"
+    bot_mode: str = "polling"
+    webhook_base_url: str | None = None
+    webhook_path: str = "/webhook"
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_secret: str | None = None
+    # /metrics is served on the webhook port; polling mode needs its own port
+    metrics_port: int | None = None
+
+    @model_validator(mode="after")
+    def _default_session_write_back(self) -> "Settings":
+        if self.session_write_back is None:
+            self.session_write_back = self.bot_mode != "webhook"
+        return self
+
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -1,12 +1,62 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .config import settings
+from .services import metrics
+
+
+logger = logging.getLogger(__name__)
+
+pool_wait_seconds = metrics.histogram("db_pool_wait_seconds", "Time spent waiting for a pool connection")
+pool_overflow_total = metrics.counter("db_pool_overflow_total", "Connections opened beyond pool_size")
+pool_timeouts_total = metrics.counter("db_pool_timeouts_total", "Checkouts that hit pool_timeout")
+
 
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        overflow_before = self._overflow
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_timeouts_total.inc()
+            raise
+        finally:
+            pool_wait_seconds.observe(time.perf_counter() - started)
+            if self._overflow > overflow_before:
+                pool_overflow_total.inc()
 
-engine = create_async_engine(settings.database_url, echo=False)
+
+engine = create_async_engine(
+    settings.database_url,
+    echo=False,
+    poolclass=InstrumentedPool,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=settings.db_pool_pre_ping,
+    connect_args={"prepared_statement_cache_size": settings.db_statement_cache_size},
+)
 SessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+metrics.gauge("db_pool_checked_out", "Connections currently checked out", lambda: engine.pool.checkedout())
+metrics.gauge("db_pool_overflow", "Overflow connections currently open", lambda: max(engine.pool.overflow(), 0))
+metrics.gauge("db_pool_size", "Configured pool size", lambda: engine.pool.size())
+
+
+def asyncpg_dsn() -> str:
+    """DATABASE_URL in the plain form asyncpg.connect() expects."""
+    url = make_url(settings.database_url).set(drivername="postgresql")
+    return url.render_as_string(hide_password=False)
+
 
 class Base(DeclarativeBase):
     pass
@@ -15,3 +65,50 @@ class Base(DeclarativeBase):
 async def get_session() -> AsyncSession:
     async with SessionLocal() as session:
         yield session
+
+
+class LazySession:
+    """Per-update stand-in for AsyncSession that opens the real one on first use."""
+
+    def __init__(self, factory: async_sessionmaker = SessionLocal) -> None:
+        self._factory = factory
+        self._session: AsyncSession | None = None
+        self._after_commit: list[Callable[[], Awaitable[Any]]] = []
+        self.info: dict[str, Any] = {}
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._session is None:
+            self._session = self._factory()
+        return getattr(self._session, name)
+
+    def after_commit(self, fn: Callable[[], Awaitable[Any]]) -> None:
+        self._after_commit.append(fn)
+
+    async def commit(self) -> None:
+        if self._session is not None:
+            await self._session.commit()
+        # callbacks can queue further callbacks (log_event on a failed send)
+        while self._after_commit:
+            callbacks, self._after_commit = self._after_commit, []
+            for fn in callbacks:
+                try:
+                    await fn()
+                except Exception:
+                    logger.exception("after_commit callback failed")
+        # callbacks may touch the session (screen ids, logs); keep those too
+        if self._session is not None and self._session.in_transaction():
+            await self._session.commit()
+
+    async def rollback(self) -> None:
+        self._after_commit.clear()
+        if self._session is not None:
+            await self._session.rollback()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
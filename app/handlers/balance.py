@@ -141,7 +141,6 @@ async def balance_details(call: CallbackQuery, session: AsyncSession):
         return
     balance = await repo.get_balance(session, user["user_id"])
     await repo.set_state_clear(session, call.from_user.id, "menu")
-    await session.commit()
     await edit_screen(
         call.message,
         session,
@@ -157,7 +156,6 @@ async def balance_details(call: CallbackQuery, session: AsyncSession):
 @router.callback_query(F.data == "topup:start")
 async def topup_start(call: CallbackQuery, session: AsyncSession):
     await repo.set_state_clear(session, call.from_user.id, "topup_method")
-    await session.commit()
     await edit_screen(call.message, session, "Способ пополнения:", reply_markup=topup_method_kb())
     await call.answer()
 
@@ -166,7 +164,6 @@ async def topup_start(call: CallbackQuery, session: AsyncSession):
 async def topup_method(call: CallbackQuery, session: AsyncSession):
     method = call.data.split(":")[2]
     await repo.set_state_payload(session, call.from_user.id, "topup_amount", "topup", {"method": method})
-    await session.commit()
     await edit_screen(call.message, session, "Выберите сумму пополнения:", reply_markup=topup_amount_kb())
     await call.answer()
 
@@ -197,7 +194,6 @@ async def topup_amount(call: CallbackQuery, session: AsyncSession, bot):
             "topup",
             {"amount": amount, "method": "transfer", "code": code},
         )
-        await session.commit()
 
         if link:
             text = (
@@ -231,7 +227,6 @@ async def topup_amount(call: CallbackQuery, session: AsyncSession, bot):
         return
 
     await repo.set_state_clear(session, call.from_user.id, "menu")
-    await session.commit()
     await edit_screen(call.message, session, "Этот способ оплаты временно недоступен.", reply_markup=access_payment_menu_kb())
     await call.answer()
 
@@ -244,7 +239,6 @@ async def topup_back(call: CallbackQuery, session: AsyncSession):
         return
     balance = await repo.get_balance(session, user["user_id"])
     await repo.set_state_clear(session, call.from_user.id, "menu")
-    await session.commit()
     await edit_screen(call.message, session, f"Ваш баланс: {balance} ₽", reply_markup=access_payment_menu_kb())
     await call.answer()
 
@@ -256,7 +250,6 @@ async def topup_cancel(call: CallbackQuery, session: AsyncSession):
         await call.answer()
         return
     await repo.set_state_clear(session, call.from_user.id, "menu")
-    await session.commit()
     await render_menu(call.message, session, user.get("role", "user"), tg_user_id=call.from_user.id)
     await call.answer()
 
@@ -274,7 +267,6 @@ async def renew_start(call: CallbackQuery, session: AsyncSession):
         return
     index = 0
     await repo.set_state_payload(session, call.from_user.id, "renew", "renew", {"index": index})
-    await session.commit()
     total = len(profiles)
     text = format_profile(profiles[index], index + 1, total)
     await edit_screen(call.message, session, text, reply_markup=renew_kb(index + 1, total), parse_mode="HTML")
@@ -303,7 +295,6 @@ async def renew_nav(call: CallbackQuery, session: AsyncSession):
     else:
         index = (index + 1) % total
     await repo.set_state_payload(session, call.from_user.id, "renew", "renew", {"index": index})
-    await session.commit()
     text = format_profile(profiles[index], index + 1, total)
     await edit_screen(call.message, session, text, reply_markup=renew_kb(index + 1, total), parse_mode="HTML")
     await call.answer()
@@ -328,7 +319,6 @@ async def renew_select(call: CallbackQuery, session: AsyncSession):
         await call.answer("Пробные ключи продлевать нельзя.", show_alert=True)
         return
     await repo.set_state_payload(session, call.from_user.id, "renew_plan", "renew", {"index": index, "profile_id": selected["id"]})
-    await session.commit()
     plans = await repo.list_plans(session)
     if not plans:
         await edit_screen(call.message, session, "Тарифы не найдены.")
@@ -392,14 +382,17 @@ async def renew_apply(call: CallbackQuery, session: AsyncSession):
     new_balance = await repo.apply_balance_delta(session, user["user_id"], -price, "renew", {"plan_id": plan_id, "profile_id": profile_id})
     await repo.log_event(session, "payments", "info", user["tg_user_id"], user["user_id"], "renewed", None, {"plan_id": plan_id, "profile_id": profile_id, "amount": price})
     await repo.set_state_clear(session, call.from_user.id, "menu")
-    await session.commit()
 
-    await edit_screen(
-        call.message,
-        session,
-        f"✅ Продление успешно.\nДействует до: {format_dt(new_until)}\nБаланс: {new_balance} ₽",
-        reply_markup=build_menu(user.get("role", "user")),
-    )
+    # only once the debit and the new expiry are committed
+    async def show_renewed():
+        await edit_screen(
+            call.message,
+            session,
+            f"✅ Продление успешно.\nДействует до: {format_dt(new_until)}\nБаланс: {new_balance} ₽",
+            reply_markup=build_menu(user.get("role", "user")),
+        )
+
+    session.after_commit(show_renewed)
     await call.answer()
 
 
@@ -410,7 +403,6 @@ async def back_to_menu(call: CallbackQuery, session: AsyncSession):
         await call.answer()
         return
     await repo.set_state_clear(session, call.from_user.id, "menu")
-    await session.commit()
     await render_menu(call.message, session, user.get("role", "user"), tg_user_id=call.from_user.id)
     await call.answer()
 
@@ -425,7 +417,6 @@ async def renew_back_exit(call: CallbackQuery, session: AsyncSession):
         profiles = await repo.list_active_profiles(session, user["user_id"])
         if not profiles:
             await repo.set_state_clear(session, call.from_user.id, "menu")
-            await session.commit()
             await edit_screen(call.message, session, "У вас нет активных ключей.")
             await call.answer()
             return
@@ -433,14 +424,12 @@ async def renew_back_exit(call: CallbackQuery, session: AsyncSession):
         index = int((payload.get("renew") or {}).get("index") or 0)
         index = max(0, min(index, len(profiles) - 1))
         await repo.set_state_payload(session, call.from_user.id, "renew", "renew", {"index": index})
-        await session.commit()
         text = format_profile(profiles[index], index + 1, len(profiles))
         await edit_screen(call.message, session, text, reply_markup=renew_kb(index + 1, len(profiles)), parse_mode="HTML")
         await call.answer()
         return
 
     await repo.set_state_clear(session, call.from_user.id, "menu")
-    await session.commit()
     await render_menu(call.message, session, user.get("role", "user"), tg_user_id=call.from_user.id)
     await call.answer()
 
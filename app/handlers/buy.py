@@ -104,7 +104,6 @@ def step2_text() -> str:
 async def buy_start(message: Message, session: AsyncSession, tg_user_id: int | None = None):
     user_id = tg_user_id or message.from_user.id
     await repo.set_state_clear(session, user_id, "buy_protocol")
-    await session.commit()
 
     await edit_screen(message, session, step1_text(), reply_markup=proto_keyboard(), tg_user_id=user_id)
 
@@ -121,14 +120,12 @@ async def buy_callbacks(call: CallbackQuery, session: AsyncSession):
 
     if action == "cancel":
         await repo.set_state_clear(session, call.from_user.id, "menu")
-        await session.commit()
         await edit_screen(call.message, session, "Отменено.", reply_markup=build_menu(user.get("role", "user")))
         await call.answer()
         return
 
     if action == "back":
         await repo.set_state_clear(session, call.from_user.id, "buy_protocol")
-        await session.commit()
         await edit_screen(call.message, session, step1_text(), reply_markup=proto_keyboard())
         await call.answer()
         return
@@ -137,7 +134,6 @@ async def buy_callbacks(call: CallbackQuery, session: AsyncSession):
         protocol = parts[2]
         await repo.set_state_payload(session, call.from_user.id, "buy_server", "connect", {"protocol": protocol})
         servers = await repo.list_servers(session)
-        await session.commit()
 
         if not servers:
             await edit_screen(call.message, session, "⚠️ Серверов пока нет.\nНапишите в 💬 Поддержка.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="buy:cancel")]]))
@@ -152,7 +148,6 @@ async def buy_callbacks(call: CallbackQuery, session: AsyncSession):
         server_id = int(parts[2])
         await repo.set_state_payload(session, call.from_user.id, "buy_plan", "connect", {"server_id": server_id})
         plans = await repo.list_plans(session)
-        await session.commit()
 
         if not plans:
             await edit_screen(call.message, session, "⚠️ Тарифов пока нет.\nНапишите в 💬 Поддержка.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="buy:cancel")]]))
@@ -171,7 +166,6 @@ async def buy_callbacks(call: CallbackQuery, session: AsyncSession):
             return
 
         await repo.set_state_payload(session, call.from_user.id, "buy_plan", "buy", {"plan_id": plan_id})
-        await session.commit()
 
         is_trial = int(plan.get("price_minor") or 0) == 0 or (plan.get("code") or "").startswith("trial")
         payload = user.get("payload") or {}
@@ -196,14 +190,17 @@ async def buy_callbacks(call: CallbackQuery, session: AsyncSession):
             )
             await repo.set_state_clear(session, call.from_user.id, "menu")
             await repo.log_event(session, "user_actions", "info", user["tg_user_id"], user["user_id"], "trial_issued", None, {"plan_id": plan_id})
-            await session.commit()
 
-            await edit_screen(
-                call.message,
-                session,
-                f"✅ Пробный доступ активирован.\nВаш ключ (заглушка):\n{config_uri}",
-                reply_markup=instructions_keyboard(),
-            )
+            # only once the key is committed
+            async def show_trial():
+                await edit_screen(
+                    call.message,
+                    session,
+                    f"✅ Пробный доступ активирован.\nВаш ключ (заглушка):\n{config_uri}",
+                    reply_markup=instructions_keyboard(),
+                )
+
+            session.after_commit(show_trial)
             await call.answer()
             return
 
@@ -231,14 +228,17 @@ async def buy_callbacks(call: CallbackQuery, session: AsyncSession):
         )
         await repo.set_state_clear(session, call.from_user.id, "menu")
         await repo.log_event(session, "payments", "info", user["tg_user_id"], user["user_id"], "balance_debit", None, {"plan_id": plan_id, "amount": price})
-        await session.commit()
 
-        await edit_screen(
-            call.message,
-            session,
-            f"✅ Ключ выдан.\nВаш ключ (заглушка):\n{config_uri}\n\nОстаток баланса: {new_balance} ₽",
-            reply_markup=instructions_keyboard(),
-        )
+        # only once the debit and the key are committed
+        async def show_key():
+            await edit_screen(
+                call.message,
+                session,
+                f"✅ Ключ выдан.\nВаш ключ (заглушка):\n{config_uri}\n\nОстаток баланса: {new_balance} ₽",
+                reply_markup=instructions_keyboard(),
+            )
+
+        session.after_commit(show_key)
         await call.answer()
         return
 
@@ -3,7 +3,7 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..services import repo
+from ..services import outbound, repo
 from .screen import edit_screen, edit_screen_by_user
 
 router = Router()
@@ -76,7 +76,6 @@ async def support_admin_actions(call: CallbackQuery, session: AsyncSession):
 
     if action == "reply":
         await repo.set_state_payload(session, call.from_user.id, "support_reply", "support", {"ticket_id": ticket_id})
-        await session.commit()
         await call.answer()
         try:
             await call.message.reply(f"Введите ответ на обращение #{display_id}.")
@@ -86,14 +85,18 @@ async def support_admin_actions(call: CallbackQuery, session: AsyncSession):
 
     if action == "close":
         await repo.close_support_ticket(session, ticket_id)
-        await session.commit()
-        try:
-            await call.message.bot.send_message(
-                ticket["chat_id"],
-                f"🔒 Обращение #{display_id} закрыто администратором.",
-            )
-        except Exception:
-            pass
+
+        async def notify_user():
+            try:
+                await call.message.bot.send_message(
+                    ticket["chat_id"],
+                    f"🔒 Обращение #{display_id} закрыто администратором.",
+                )
+            except Exception:
+                pass
+
+        session.after_commit(notify_user)
+
         try:
             await call.message.edit_text(f"Обращение #{display_id} закрыто.")
         except Exception:
@@ -123,23 +126,26 @@ async def unknown(message: Message, session: AsyncSession):
             if ticket:
                 display_id = ticket.get("user_ticket_id") or ticket_id
                 await repo.add_support_message(session, ticket_id, "admin", message.text)
-                await session.commit()
-                try:
-                    await edit_screen_by_user(
-                        message.bot,
-                        ticket["chat_id"],
-                        session,
-                        ticket["tg_user_id"],
-                        f"💬 Ответ поддержки (обращение #{display_id}):\n\n{message.text}",
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text="К обращениям", callback_data="profile:tickets")],
-                            [InlineKeyboardButton(text="В меню", callback_data="nav:menu")],
-                        ]),
-                    )
-                except Exception:
-                    pass
+
+                async def notify_user():
+                    try:
+                        await edit_screen_by_user(
+                            message.bot,
+                            ticket["chat_id"],
+                            session,
+                            ticket["tg_user_id"],
+                            f"💬 Ответ поддержки (обращение #{display_id}):\n\n{message.text}",
+                            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                                [InlineKeyboardButton(text="К обращениям", callback_data="profile:tickets")],
+                                [InlineKeyboardButton(text="В меню", callback_data="nav:menu")],
+                            ]),
+                        )
+                    except Exception:
+                        pass
+
+                session.after_commit(notify_user)
+
                 await repo.set_state_clear(session, message.from_user.id, "menu")
-                await session.commit()
                 await message.reply(f"Ответ отправлен пользователю (обращение #{display_id}).")
             else:
                 await message.reply("Обращение не найдено.")
@@ -170,7 +176,6 @@ async def unknown(message: Message, session: AsyncSession):
             open_ticket = await repo.add_support_ticket(session, user, message.text)
         else:
             await repo.add_support_message(session, open_ticket["id"], "user", message.text)
-        await session.commit()
 
         display_ticket_id = open_ticket.get("user_ticket_id") or open_ticket["id"]
         text_admin = (
@@ -179,30 +184,35 @@ async def unknown(message: Message, session: AsyncSession):
             f"Пользователь: @{user.get('username') or '-'} ({user['tg_user_id']})\n\n"
             f"{message.text}"
         )
-        try:
-            await message.bot.send_message(
-                admin_group_id,
-                text_admin,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
-                    InlineKeyboardButton(text="Ответить", callback_data=f"support:reply:{open_ticket['id']}"),
-                    InlineKeyboardButton(text="Закрыть", callback_data=f"support:close:{open_ticket['id']}"),
-                ]]),
-            )
-        except Exception as exc:
-            try:
-                await repo.log_event(
-                    session,
-                    "user_actions",
-                    "error",
-                    user.get("tg_user_id"),
-                    user.get("user_id"),
-                    "support_send_failed",
-                    str(exc),
-                    {"admin_group_id": admin_group_id, "ticket_id": open_ticket.get("id")},
-                )
-            except Exception:
-                pass
+
+        async def notify_admins():
+            with outbound.lane(outbound.ADMIN):
+                try:
+                    await message.bot.send_message(
+                        admin_group_id,
+                        text_admin,
+                        parse_mode="HTML",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                            InlineKeyboardButton(text="Ответить", callback_data=f"support:reply:{open_ticket['id']}"),
+                            InlineKeyboardButton(text="Закрыть", callback_data=f"support:close:{open_ticket['id']}"),
+                        ]]),
+                    )
+                except Exception as exc:
+                    try:
+                        await repo.log_event(
+                            session,
+                            "user_actions",
+                            "error",
+                            user.get("tg_user_id"),
+                            user.get("user_id"),
+                            "support_send_failed",
+                            str(exc),
+                            {"admin_group_id": admin_group_id, "ticket_id": open_ticket.get("id")},
+                        )
+                    except Exception:
+                        pass
+
+        session.after_commit(notify_admins)
 
         from .menu import build_menu
         await edit_screen(
@@ -224,7 +234,6 @@ async def unknown(message: Message, session: AsyncSession):
         )
         if ok:
             await repo.set_state_clear(session, message.from_user.id, "menu")
-            await session.commit()
             from .menu import render_menu
             await render_menu(message, session, user.get("role", "user"), tg_user_id=message.from_user.id)
             await edit_screen(message, session, text, reply_markup=kb)
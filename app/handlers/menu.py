@@ -32,6 +32,7 @@ def build_menu(role: str) -> InlineKeyboardMarkup:
 
 def admin_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📥 Очередь оплат", callback_data="pay:next")],
         [InlineKeyboardButton(text="🏷️ Управление промокодами", callback_data="admin:promo")],
         [InlineKeyboardButton(text="🖥️ Управление серверами", callback_data="admin:servers")],
         [InlineKeyboardButton(text="👥 Управление пользователями", callback_data="admin:users")],
@@ -43,12 +44,6 @@ def admin_kb() -> InlineKeyboardMarkup:
 
 async def render_menu(message: Message, session: AsyncSession, role: str, tg_user_id: int | None = None):
     text = "✅ Админ-меню" if role == "admin" else "✅ Меню"
-    user_id = tg_user_id or message.from_user.id
-    try:
-        await repo.process_referral_pending_all(session)
-        await session.commit()
-    except Exception:
-        pass
     await edit_screen(message, session, text, reply_markup=build_menu(role), tg_user_id=tg_user_id)
 
 
@@ -67,15 +62,13 @@ async def cmd_start(message: Message, session: AsyncSession):
             except Exception:
                 referrer_id = None
 
-    user = await repo.upsert_user(
+    user = await repo.bootstrap_user(
         session,
         message.from_user.id,
         message.chat.id,
         message.from_user.username,
         referrer_id=referrer_id,
     )
-    await repo.ensure_session(session, message.from_user.id)
-    await session.commit()
 
     await render_menu(message, session, user["role"], tg_user_id=message.from_user.id)
     try:
@@ -129,7 +122,6 @@ async def menu_actions(call: CallbackQuery, session: AsyncSession):
 
     if action == "promo":
         await repo.set_state_clear(session, call.from_user.id, "promo_wait")
-        await session.commit()
         await edit_screen(
             call.message,
             session,
@@ -142,7 +134,6 @@ async def menu_actions(call: CallbackQuery, session: AsyncSession):
         return
     if action == "support":
         await repo.set_state_clear(session, call.from_user.id, "support_wait")
-        await session.commit()
         await edit_screen(
             call.message,
             session,
@@ -1,22 +1,64 @@
 ﻿from __future__ import annotations
 
+import contextlib
+
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta, timezone
 
-from ..services import repo
+from ..config import settings
+from ..services import moderation, repo
+from ..services.blob_store import blob_store
+from ..services.fanout import fan_out
+from ..services.proof_fingerprints import find_duplicates, fingerprint_row
+from ..services.proof_ingest import ProofRejected, ingest_proof
+from ..services.statement_import import StatementError, import_statement, read_statement
 from .menu import build_menu
 from .screen import edit_screen_by_user
 
 router = Router()
 
 
-def admin_payment_keyboard(order_id: int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[[ 
+def admin_payment_keyboard(order_id: int, original: bool = False) -> InlineKeyboardMarkup:
+    rows = [[
         InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"pay:approve:{order_id}"),
         InlineKeyboardButton(text="❌ Отклонить", callback_data=f"pay:reject:{order_id}"),
-    ]])
+    ]]
+    if original:
+        rows.append([InlineKeyboardButton(text="🖼 Оригинал", callback_data=f"pay:orig:{order_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def duplicate_warning(matches: list[dict], user_id: int) -> str:
+    lines = []
+    for row in matches[:5]:
+        kind = "точная копия" if row["exact"] else "похожее изображение"
+        who = "тот же пользователь" if row["user_id"] == user_id else f"@{row.get('username') or '-'} ({row['tg_user_id']})"
+        lines.append(f"• Order #{row['order_id']} ({row['status']}): {kind}, {who}")
+    if len(matches) > 5:
+        lines.append(f"…и ещё {len(matches) - 5}")
+    return "\n\n⚠️ Возможный повтор чека:\n" + "\n".join(lines)
+
+
+async def close_admin_copy(call: CallbackQuery, text: str) -> None:
+    # the copy may already be gone (moderation cleanup); only label it if it can't be deleted
+    if not call.message:
+        return
+    try:
+        await call.message.delete()
+        return
+    except Exception:
+        pass
+    try:
+        if call.message.text:
+            await call.message.edit_text(text)
+        else:
+            await call.message.edit_caption(caption=text)
+    except Exception:
+        pass
 
 
 def instructions_keyboard() -> InlineKeyboardMarkup:
@@ -26,6 +68,145 @@ def instructions_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
+async def send_proof(bot, chat_id: int, order_id: int, proof: dict | None, text: str):
+    # thumbnail preview when there is one, otherwise Telegram's cached copy first and
+    # the blob streamed from disk if the file_id is gone
+    sources = []
+    thumb_sha256 = (proof or {}).get("thumb_sha256")
+    if thumb_sha256 and blob_store.exists(thumb_sha256):
+        sources.append(FSInputFile(blob_store.path(thumb_sha256), filename="preview.jpg"))
+    if proof and proof.get("tg_file_id"):
+        sources.append(proof["tg_file_id"])
+    if proof and proof.get("blob_sha256") and blob_store.exists(proof["blob_sha256"]):
+        sources.append(FSInputFile(blob_store.path(proof["blob_sha256"]), filename=proof.get("file_name") or "proof"))
+    mime = ((proof or {}).get("mime_type") or "").lower()
+    as_photo = mime.startswith("image/") or mime == ""
+    keyboard = admin_payment_keyboard(order_id, original=bool(thumb_sha256))
+
+    if not sources:
+        return await bot.send_message(chat_id, text, reply_markup=keyboard)
+    error = None
+    for source in sources:
+        if as_photo:
+            try:
+                return await bot.send_photo(chat_id, source, caption=text, reply_markup=keyboard)
+            except Exception:
+                pass
+        try:
+            return await bot.send_document(chat_id, source, caption=text, reply_markup=keyboard)
+        except Exception as exc:
+            error = exc
+    raise error
+
+
+async def approve_topup(session: AsyncSession, bot, order: dict, source: str, skip: tuple[int, int] | None = None) -> int | None:
+    """Mark a pending top-up paid, credit the balance and notify the user after commit.
+
+    Returns the new balance, or None if the order was no longer pending. The
+    admins' copies of the proof are deleted, except skip=(chat_id, message_id).
+    """
+    order_id = order["id"]
+    if not await repo.transition_order(session, order_id, "pending", "paid"):
+        return None
+    await moderation.resolve(session, bot, order_id, "approved", skip)
+    amount = int((order.get("meta") or {}).get("amount") or order["amount_minor"])
+    new_balance = await repo.apply_balance_delta(session, order["user_id"], amount, "topup", {"order_id": order_id})
+    await repo.log_event(session, "admin_actions", "info", order["tg_user_id"], order["user_id"], "topup_approved", f"order {order_id}", {"order_id": order_id, "amount": amount, "source": source})
+    try:
+        referred_user = await repo.load_user_by_id(session, order["user_id"])
+        if referred_user and referred_user.get("referrer_id"):
+            ref_user_id = await repo.resolve_referrer_user_id(session, int(referred_user["referrer_id"]))
+            if ref_user_id and ref_user_id != order["user_id"]:
+                await repo.add_referral_pending(
+                    session,
+                    referrer_user_id=ref_user_id,
+                    referred_user_id=int(order["user_id"]),
+                    amount_minor=amount,
+                    order_id=order_id,
+                )
+    except Exception as exc:
+        await repo.log_event(
+            session,
+            "referral",
+            "error",
+            order["tg_user_id"],
+            order["user_id"],
+            "referral_pending_failed",
+            str(exc),
+            {"order_id": order_id},
+        )
+
+    role = "user"
+    user_info = await repo.load_user_with_session(session, order["tg_user_id"])
+    if user_info and user_info.get("role"):
+        role = user_info["role"]
+
+    async def notify_user():
+        await edit_screen_by_user(
+            bot,
+            order["chat_id"],
+            session,
+            order["tg_user_id"],
+            f"✅ Баланс пополнен на {amount} ₽.\nТекущий баланс: {new_balance} ₽",
+            reply_markup=build_menu(role),
+        )
+
+    session.after_commit(notify_user)
+
+    return new_balance
+
+
+@router.message(F.document, F.caption.regexp(r"^/import\b"))
+async def import_statement_file(message: Message, session: AsyncSession, bot):
+    user = await repo.load_user_with_session(session, message.from_user.id)
+    if not user or user.get("role") != "admin":
+        raise SkipHandler()
+
+    document = message.document
+    try:
+        tg_file = await bot.get_file(document.file_id)
+    except TelegramBadRequest:
+        await message.answer("Не удалось скачать файл (Telegram отдаёт ботам файлы до 20 МБ).")
+        return
+    stream = bot.session.stream_content(
+        url=bot.session.api.file_url(bot.token, tg_file.file_path),
+        timeout=settings.statement_download_timeout,
+        chunk_size=64 * 1024,
+    )
+
+    async def credit(order: dict):
+        return await approve_topup(session, bot, order, "statement")
+
+    try:
+        async with contextlib.aclosing(stream):
+            report = await import_statement(session, read_statement(stream, document.file_name), credit, settings.statement_batch_size)
+    except StatementError as exc:
+        await message.answer(f"Не удалось разобрать выписку: {exc}. Совпадения до этого места зачислены.")
+        return
+
+    await repo.log_event(
+        session,
+        "admin_actions",
+        "info",
+        user["tg_user_id"],
+        user["user_id"],
+        "statement_imported",
+        document.file_name,
+        {key: value if isinstance(value, int) else len(value) for key, value in report.items()},
+    )
+    lines = [
+        f"📄 Выписка: {document.file_name or '-'}",
+        f"Строк: {report['rows']}, поступлений: {report['incoming']}, с кодом: {report['coded']}",
+        f"✅ Зачислено: {report['credited']}",
+        f"Уже обработаны: {report['settled']}",
+    ]
+    if report["mismatch"]:
+        lines.append(f"⚠️ Сумма не совпала: {', '.join(report['mismatch'][:10])}")
+    if report["unknown"]:
+        lines.append(f"❓ Код не найден: {', '.join(report['unknown'][:10])}")
+    await message.answer("\n".join(lines))
+
+
 @router.message(F.photo | F.document)
 async def handle_payment_proof(message: Message, session: AsyncSession, bot):
     user = await repo.load_user_with_session(session, message.from_user.id)
@@ -92,14 +273,19 @@ async def handle_payment_proof(message: Message, session: AsyncSession, bot):
             return
         code = None
 
-    tg_file = await bot.get_file(file_id)
-    file_bytes = await bot.download_file(tg_file.file_path)
-    if hasattr(file_bytes, "read"):
-        data = file_bytes.read()
-    elif hasattr(file_bytes, "getvalue"):
-        data = file_bytes.getvalue()
-    else:
-        data = bytes(file_bytes)
+    try:
+        stored = await ingest_proof(bot, file_id, mime_type, file_size)
+    except ProofRejected as exc:
+        if exc.reason == "size":
+            text = f"Файл слишком большой (максимум {settings.proof_max_bytes // (1024 * 1024)} МБ). Отправьте фото или сжатый PDF."
+        else:
+            text = "Поддерживаются только фото (JPG, PNG, WEBP) и PDF."
+        await edit_screen_by_user(bot, message.chat.id, session, message.from_user.id, text)
+        try:
+            await message.delete()
+        except Exception:
+            pass
+        return
 
     if user.get("state") == "topup_proof":
         meta = {"type": "topup", "amount": amount, "tg_file_id": file_id}
@@ -123,10 +309,32 @@ async def handle_payment_proof(message: Message, session: AsyncSession, bot):
             meta={"protocol": protocol, "server_id": server_id, "tg_file_id": file_id},
         )
 
-    await repo.insert_payment_proof(session, order_id, file_id, file_name, mime_type, file_size, data)
+    proof_id = await repo.insert_payment_proof(
+        session,
+        order_id,
+        file_id,
+        file_name,
+        stored["mime_type"],
+        stored["file_size"],
+        stored["blob_sha256"],
+        thumb_sha256=stored["thumb_sha256"],
+        original_sha256=stored["original_sha256"],
+    )
+    duplicates = await find_duplicates(session, stored["upload_sha256"], stored["dhash"], order_id)
+    await repo.insert_proof_fingerprints(session, [fingerprint_row(proof_id, order_id, stored["upload_sha256"], stored["dhash"])])
     await repo.log_event(session, "payments", "info", user["tg_user_id"], user["user_id"], "payment_proof_uploaded", None, {"order_id": order_id})
+    if duplicates:
+        await repo.log_event(
+            session,
+            "payments",
+            "warning",
+            user["tg_user_id"],
+            user["user_id"],
+            "payment_proof_duplicate",
+            None,
+            {"order_id": order_id, "matches": [{"order_id": row["order_id"], "exact": row["exact"]} for row in duplicates]},
+        )
     await repo.set_state_clear(session, message.from_user.id, "menu")
-    await session.commit()
 
     await edit_screen_by_user(
         bot,
@@ -161,35 +369,19 @@ async def handle_payment_proof(message: Message, session: AsyncSession, bot):
             f"Тариф: {plan['title']}\n"
             f"Сумма: {price} RUB"
         )
+    if duplicates:
+        text += duplicate_warning(duplicates, user["user_id"])
 
+    await repo.insert_moderation_item(session, order_id, text)
     proof = await repo.load_payment_proof(session, order_id)
-    for admin_id in admin_ids:
-        if proof and proof.get("tg_file_id"):
-            mime = (proof.get("mime_type") or "").lower()
-            try:
-                if mime.startswith("image/") or mime == "":
-                    await bot.send_photo(
-                        admin_id,
-                        proof["tg_file_id"],
-                        caption=text,
-                        reply_markup=admin_payment_keyboard(order_id),
-                    )
-                else:
-                    await bot.send_document(
-                        admin_id,
-                        proof["tg_file_id"],
-                        caption=text,
-                        reply_markup=admin_payment_keyboard(order_id),
-                    )
-            except Exception:
-                await bot.send_document(
-                    admin_id,
-                    proof["tg_file_id"],
-                    caption=text,
-                    reply_markup=admin_payment_keyboard(order_id),
-                )
-        else:
-            await bot.send_message(admin_id, text, reply_markup=admin_payment_keyboard(order_id))
+
+    async def notify_admins():
+        async def send(admin_id: int):
+            return await send_proof(bot, admin_id, order_id, proof, text)
+
+        fan_out("payment_proof_fanout", admin_ids, send, {"order_id": order_id}, on_delivered=moderation.recorder(bot, order_id))
+
+    session.after_commit(notify_admins)
 
 
 @router.callback_query(F.data.startswith("pay:"))
@@ -203,67 +395,81 @@ async def handle_admin_payment(call: CallbackQuery, session: AsyncSession, bot):
         await call.answer("Недостаточно прав")
         return
 
+    if action == "next":
+        item = await moderation.claim_next(session, call.from_user.id)
+        if not item:
+            await call.answer("Очередь пуста", show_alert=True)
+            return
+        order_id = item["order_id"]
+        text = item["caption"]
+        if not text:
+            order = await repo.load_order(session, order_id)
+            if not order:
+                await call.answer("Заказ не найден")
+                return
+            text = (
+                f"💳 Order #{order_id}\n"
+                f"Пользователь: @{order.get('username') or '-'} ({order['tg_user_id']})\n"
+                f"Сумма: {order['amount_minor']} {order.get('currency') or 'RUB'}"
+            )
+        proof = await repo.load_payment_proof(session, order_id)
+        await call.answer()
+        sent = await send_proof(bot, call.from_user.id, order_id, proof, text)
+        await repo.add_moderation_messages(session, order_id, {str(call.from_user.id): sent.message_id})
+        return
+
     order = await repo.load_order(session, order_id)
     if not order:
         await call.answer("Заказ не найден")
         return
 
-    if action == "approve":
-        await repo.update_order_status(session, order_id, "paid")
+    if action == "orig":
+        proof = await repo.load_payment_proof(session, order_id)
+        original_sha256 = (proof or {}).get("original_sha256")
+        if original_sha256 and blob_store.exists(original_sha256):
+            source = FSInputFile(blob_store.path(original_sha256), filename=proof.get("file_name") or "proof")
+        elif proof and proof.get("tg_file_id"):
+            source = proof["tg_file_id"]
+        else:
+            await call.answer("Оригинал недоступен", show_alert=True)
+            return
+        await call.answer()
+        await bot.send_document(call.from_user.id, source, caption=f"Order #{order_id} — оригинал")
+        return
 
-        if (order.get("meta") or {}).get("type") == "topup":
-            amount = int((order.get("meta") or {}).get("amount") or order["amount_minor"])
-            new_balance = await repo.apply_balance_delta(session, order["user_id"], amount, "topup", {"order_id": order_id})
-            await repo.log_event(session, "admin_actions", "info", order["tg_user_id"], order["user_id"], "topup_approved", f"order {order_id}", {"order_id": order_id, "amount": amount})
-            try:
-                referred_user = await repo.load_user_by_id(session, order["user_id"])
-                if referred_user and referred_user.get("referrer_id"):
-                    ref_user_id = await repo.resolve_referrer_user_id(session, int(referred_user["referrer_id"]))
-                    if ref_user_id and ref_user_id != order["user_id"]:
-                        await repo.add_referral_pending(
-                            session,
-                            referrer_user_id=ref_user_id,
-                            referred_user_id=int(order["user_id"]),
-                            amount_minor=amount,
-                            order_id=order_id,
-                        )
-            except Exception as exc:
-                await repo.log_event(
-                    session,
-                    "referral",
-                    "error",
-                    order["tg_user_id"],
-                    order["user_id"],
-                    "referral_pending_failed",
-                    str(exc),
-                    {"order_id": order_id},
-                )
-            await session.commit()
+    if action not in ("approve", "reject"):
+        await call.answer("Неизвестное действие")
+        return
 
-            role = "user"
-            user_info = await repo.load_user_with_session(session, order["tg_user_id"])
-            if user_info and user_info.get("role"):
-                role = user_info["role"]
-            await edit_screen_by_user(
-                bot,
-                order["chat_id"],
-                session,
-                order["tg_user_id"],
-                f"✅ Баланс пополнен на {amount} ₽.\nТекущий баланс: {new_balance} ₽",
-                reply_markup=build_menu(role),
-            )
-            if call.message and call.message.text:
-                await call.message.edit_text("Пополнение подтверждено.")
-            elif call.message:
-                await call.message.edit_caption("Пополнение подтверждено.")
-            if call.message:
-                try:
-                    await call.message.delete()
-                except Exception:
-                    pass
+    if not await moderation.claim(session, order_id, call.from_user.id):
+        item = await repo.load_moderation_item(session, order_id)
+        if item is not None:
+            if item["status"] == "done":
+                await close_admin_copy(call, "Заказ уже обработан.")
+                await call.answer("Заказ уже обработан", show_alert=True)
+            else:
+                await call.answer("Заявку уже проверяет другой администратор", show_alert=True)
+            return
+    skip = (call.message.chat.id, call.message.message_id) if call.message else None
+
+    if action == "approve":
+        if (order.get("meta") or {}).get("type") == "topup":
+            new_balance = await approve_topup(session, bot, order, "admin", skip)
+            if new_balance is None:
+                await moderation.resolve(session, bot, order_id, order["status"], skip)
+                await close_admin_copy(call, "Заказ уже обработан.")
+                await call.answer("Заказ уже обработан", show_alert=True)
+                return
+            await close_admin_copy(call, "Пополнение подтверждено.")
             await call.answer()
             return
 
+        if not await repo.transition_order(session, order_id, "pending", "paid"):
+            await moderation.resolve(session, bot, order_id, order["status"], skip)
+            await close_admin_copy(call, "Заказ уже обработан.")
+            await call.answer("Заказ уже обработан", show_alert=True)
+            return
+        await moderation.resolve(session, bot, order_id, "approved", skip)
         plan = await repo.load_plan(session, order["plan_id"])
         access_until = None
         if plan:
@@ -300,55 +506,48 @@ async def handle_admin_payment(call: CallbackQuery, session: AsyncSession, bot):
                 str(exc),
                 {"order_id": order_id},
             )
-        await session.commit()
 
-        await edit_screen_by_user(
-            bot,
-            order["chat_id"],
-            session,
-            order["tg_user_id"],
-            f"✅ Оплата подтверждена.\nВаш ключ (заглушка):\n{config_uri}",
-            reply_markup=instructions_keyboard(),
-        )
-        if call.message and call.message.text:
-            await call.message.edit_text("Оплата подтверждена.")
-        elif call.message:
-            await call.message.edit_caption("Оплата подтверждена.")
-        if call.message:
-            try:
-                await call.message.delete()
-            except Exception:
-                pass
+        async def notify_user():
+            await edit_screen_by_user(
+                bot,
+                order["chat_id"],
+                session,
+                order["tg_user_id"],
+                f"✅ Оплата подтверждена.\nВаш ключ (заглушка):\n{config_uri}",
+                reply_markup=instructions_keyboard(),
+            )
+
+        session.after_commit(notify_user)
+
+        await close_admin_copy(call, "Оплата подтверждена.")
         await call.answer()
         return
 
     if action == "reject":
-        await repo.update_order_status(session, order_id, "failed")
+        if not await repo.transition_order(session, order_id, "pending", "failed"):
+            await moderation.resolve(session, bot, order_id, order["status"], skip)
+            await close_admin_copy(call, "Заказ уже обработан.")
+            await call.answer("Заказ уже обработан", show_alert=True)
+            return
+        await moderation.resolve(session, bot, order_id, "rejected", skip)
         await repo.log_event(session, "admin_actions", "info", order["tg_user_id"], order["user_id"], "payment_rejected", f"order {order_id}", {"order_id": order_id})
-        await session.commit()
 
         user_info = await repo.load_user_with_session(session, order["tg_user_id"])
         role = "user"
         if user_info and user_info.get("role"):
             role = user_info["role"]
-        await edit_screen_by_user(
-            bot,
-            order["chat_id"],
-            session,
-            order["tg_user_id"],
-            "Оплата не подтверждена. Если это ошибка — обратитесь в поддержку.",
-            reply_markup=build_menu(role),
-        )
-        if call.message and call.message.text:
-            await call.message.edit_text("Оплата отклонена.")
-        elif call.message:
-            await call.message.edit_caption("Оплата отклонена.")
-        if call.message:
-            try:
-                await call.message.delete()
-            except Exception:
-                pass
-        await call.answer()
-        return
 
-    await call.answer("Неизвестное действие")
+        async def notify_user():
+            await edit_screen_by_user(
+                bot,
+                order["chat_id"],
+                session,
+                order["tg_user_id"],
+                "Оплата не подтверждена. Если это ошибка — обратитесь в поддержку.",
+                reply_markup=build_menu(role),
+            )
+
+        session.after_commit(notify_user)
+
+        await close_admin_copy(call, "Оплата отклонена.")
+        await call.answer()
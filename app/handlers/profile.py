@@ -7,6 +7,7 @@ from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, C
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..services import repo
+from ..services.fanout import fan_out
 from .screen import edit_screen, edit_screen_by_user
 
 router = Router()
@@ -203,11 +204,6 @@ def build_profile_text(user: dict, profiles: list[dict], balance: int, settings:
 
 
 async def build_referral_view(session: AsyncSession, bot, user: dict, back_callback: str) -> tuple[str, InlineKeyboardMarkup]:
-    try:
-        await repo.process_referral_pending_all(session)
-        await session.commit()
-    except Exception:
-        pass
     me = await bot.get_me()
     ref_code = user.get("referral_code") or f"REF{user['user_id']}"
     ref_link = f"https://t.me/{me.username}?start=ref{ref_code}"
@@ -238,7 +234,6 @@ async def profile(message: Message, session: AsyncSession, tg_user_id: int | Non
     settings = await repo.get_user_settings(session, user["user_id"])
     text = build_profile_text(user, profiles, balance, settings)
     await repo.set_state_clear(session, user_id, "profile")
-    await session.commit()
     await edit_screen(message, session, text, reply_markup=profile_kb(), tg_user_id=user_id)
 
 
@@ -271,7 +266,6 @@ async def profile_callbacks(call: CallbackQuery, session: AsyncSession, bot):
             await call.answer()
             return
         await repo.set_state_payload(session, call.from_user.id, "payhist", "payhist", {"index": 0, "open": False, "file_msg_id": None})
-        await session.commit()
         total = len(history)
         text = format_payment(history[0], 1, total)
         await edit_screen(call.message, session, text, reply_markup=payments_kb(1, total, bool(history[0].get("tg_file_id")), False))
@@ -285,7 +279,6 @@ async def profile_callbacks(call: CallbackQuery, session: AsyncSession, bot):
             await call.answer()
             return
         await repo.set_state_payload(session, call.from_user.id, "support_tickets", "tickets", {"index": 0, "view": "list"})
-        await session.commit()
         t = tickets[0]
         text = format_ticket(t, 1, len(tickets))
         await edit_screen(call.message, session, text, reply_markup=tickets_list_kb(1, len(tickets), t.get("status") == "open"))
@@ -296,7 +289,6 @@ async def profile_callbacks(call: CallbackQuery, session: AsyncSession, bot):
         settings = await repo.get_user_settings(session, user["user_id"])
         enabled = not bool(settings.get("notifications_enabled"))
         await repo.set_notifications(session, user["user_id"], enabled)
-        await session.commit()
         profiles = await repo.list_active_profiles(session, user["user_id"])
         balance = await repo.get_balance(session, user["user_id"])
         settings = await repo.get_user_settings(session, user["user_id"])
@@ -316,7 +308,6 @@ async def profile_callbacks(call: CallbackQuery, session: AsyncSession, bot):
             await call.answer()
             return
         await repo.set_state_payload(session, call.from_user.id, "pkeys", "pkeys", {"index": 0})
-        await session.commit()
         total = len(profiles)
         text = format_key(profiles[0], 1, total)
         await edit_screen(call.message, session, text, reply_markup=keys_kb(1, total), parse_mode="HTML")
@@ -329,7 +320,6 @@ async def profile_callbacks(call: CallbackQuery, session: AsyncSession, bot):
         settings = await repo.get_user_settings(session, user["user_id"])
         text = build_profile_text(user, profiles, balance, settings)
         await repo.set_state_clear(session, call.from_user.id, "profile")
-        await session.commit()
         await edit_screen(call.message, session, text, reply_markup=profile_kb())
         await call.answer()
         return
@@ -368,7 +358,6 @@ async def payhist_nav(call: CallbackQuery, session: AsyncSession, bot):
         index = (index + 1) % total
 
     await repo.set_state_payload(session, call.from_user.id, "payhist", "payhist", {"index": index, "open": False, "file_msg_id": None})
-    await session.commit()
     text = format_payment(history[index], index + 1, total)
     await edit_screen(call.message, session, text, reply_markup=payments_kb(index + 1, total, bool(history[index].get("tg_file_id")), False))
     await call.answer()
@@ -405,7 +394,6 @@ async def payhist_file(call: CallbackQuery, session: AsyncSession, bot):
         except Exception:
             pass
         await repo.set_state_payload(session, call.from_user.id, "payhist", "payhist", {"index": index, "open": False, "file_msg_id": None})
-        await session.commit()
         text = format_payment(item, index + 1, len(history))
         await edit_screen(call.message, session, text, reply_markup=payments_kb(index + 1, len(history), True, False))
         await call.answer()
@@ -422,7 +410,6 @@ async def payhist_file(call: CallbackQuery, session: AsyncSession, bot):
         sent = await bot.send_document(user["chat_id"], tg_file_id, caption=caption)
 
     await repo.set_state_payload(session, call.from_user.id, "payhist", "payhist", {"index": index, "open": True, "file_msg_id": sent.message_id})
-    await session.commit()
     text = format_payment(item, index + 1, len(history))
     await edit_screen(call.message, session, text, reply_markup=payments_kb(index + 1, len(history), True, True))
     await call.answer()
@@ -450,7 +437,6 @@ async def payhist_back(call: CallbackQuery, session: AsyncSession, bot):
     settings = await repo.get_user_settings(session, user["user_id"])
     text = build_profile_text(user, profiles, balance, settings)
     await repo.set_state_clear(session, call.from_user.id, "profile")
-    await session.commit()
     await edit_screen(call.message, session, text, reply_markup=profile_kb())
     await call.answer()
 
@@ -476,7 +462,6 @@ async def pkeys_nav(call: CallbackQuery, session: AsyncSession):
         index = (index + 1) % total
 
     await repo.set_state_payload(session, call.from_user.id, "pkeys", "pkeys", {"index": index})
-    await session.commit()
     text = format_key(profiles[index], index + 1, total)
     await edit_screen(call.message, session, text, reply_markup=keys_kb(index + 1, total), parse_mode="HTML")
     await call.answer()
@@ -493,7 +478,6 @@ async def pkeys_back(call: CallbackQuery, session: AsyncSession):
     settings = await repo.get_user_settings(session, user["user_id"])
     text = build_profile_text(user, profiles, balance, settings)
     await repo.set_state_clear(session, call.from_user.id, "profile")
-    await session.commit()
     await edit_screen(call.message, session, text, reply_markup=profile_kb())
     await call.answer()
 
@@ -523,7 +507,6 @@ async def ticket_nav(call: CallbackQuery, session: AsyncSession):
     else:
         index = (index + 1) % total
     await repo.set_state_payload(session, call.from_user.id, "support_tickets", "tickets", {"index": index, "view": "list"})
-    await session.commit()
     t = tickets[index]
     text = format_ticket(t, index + 1, total)
     await edit_screen(call.message, session, text, reply_markup=tickets_list_kb(index + 1, total, t.get("status") == "open"))
@@ -550,7 +533,6 @@ async def ticket_open(call: CallbackQuery, session: AsyncSession):
     text = format_ticket_messages(msgs, t["id"], t.get("user_ticket_id"))
     text = f"{text}\n\nНапишите сообщение — я отправлю его в поддержку."
     await repo.set_state_payload(session, call.from_user.id, "support_wait", "support", {"ticket_id": t["id"]})
-    await session.commit()
     await edit_screen(call.message, session, text, reply_markup=ticket_view_kb(t.get("status") == "open"))
     await call.answer()
 
@@ -573,7 +555,6 @@ async def ticket_backlist(call: CallbackQuery, session: AsyncSession):
     t = tickets[index]
     text = format_ticket(t, index + 1, len(tickets))
     await repo.set_state_payload(session, call.from_user.id, "support_tickets", "tickets", {"index": index, "view": "list"})
-    await session.commit()
     await edit_screen(call.message, session, text, reply_markup=tickets_list_kb(index + 1, len(tickets), t.get("status") == "open"))
     await call.answer()
 
@@ -598,11 +579,9 @@ async def ticket_close(call: CallbackQuery, session: AsyncSession):
         await call.answer("Обращение уже закрыто", show_alert=True)
         return
     await repo.close_support_ticket(session, t["id"])
-    await session.commit()
     tickets = await repo.list_support_tickets_for_user(session, user["user_id"])
     if not tickets:
         await repo.set_state_clear(session, call.from_user.id, "profile")
-        await session.commit()
         await edit_screen(call.message, session, "Обращений пока нет.", reply_markup=profile_back_kb())
         await call.answer()
         return
@@ -610,7 +589,6 @@ async def ticket_close(call: CallbackQuery, session: AsyncSession):
     t = tickets[index]
     text = format_ticket(t, index + 1, len(tickets))
     await repo.set_state_payload(session, call.from_user.id, "support_tickets", "tickets", {"index": index, "view": "list"})
-    await session.commit()
     await edit_screen(call.message, session, text, reply_markup=tickets_list_kb(index + 1, len(tickets), t.get("status") == "open"))
     await call.answer()
 
@@ -626,7 +604,6 @@ async def ticket_back(call: CallbackQuery, session: AsyncSession):
     settings = await repo.get_user_settings(session, user["user_id"])
     text = build_profile_text(user, profiles, balance, settings)
     await repo.set_state_clear(session, call.from_user.id, "profile")
-    await session.commit()
     await edit_screen(call.message, session, text, reply_markup=profile_kb())
     await call.answer()
 
@@ -645,7 +622,6 @@ async def ref_withdraw(call: CallbackQuery, session: AsyncSession, bot):
     if not req_id:
         await call.answer("Заявка уже в обработке", show_alert=True)
         return
-    await session.commit()
     admin_ids = await repo.load_admin_ids(session)
     text_admin = (
     "💸 <b>Заявка на вывод средств</b>\n\n"
@@ -655,8 +631,14 @@ async def ref_withdraw(call: CallbackQuery, session: AsyncSession, bot):
     f"💰 <b>Сумма:</b> <b>{wallet} ₽</b>\n"
     f"⏳ <b>Статус:</b> <i>ожидает подтверждения</i>"
 )
-    for admin_id in admin_ids:
-        await bot.send_message(admin_id, text_admin, reply_markup=referral_admin_kb(req_id), parse_mode="HTML")
+
+    async def send_request(admin_id: int):
+        return await bot.send_message(admin_id, text_admin, reply_markup=referral_admin_kb(req_id), parse_mode="HTML")
+
+    async def notify_admins():
+        fan_out("ref_withdraw_fanout", admin_ids, send_request, {"request_id": req_id})
+
+    session.after_commit(notify_admins)
 
     text, kb = await build_referral_view(session, bot, user, "profile:back")
     text = f"{text}\n\n✅ Заявка отправлена. Мы рассмотрим её в ближайшее время."
@@ -687,23 +669,27 @@ async def ref_withdraw_admin(call: CallbackQuery, session: AsyncSession, bot):
     target_user = await repo.load_user_by_id(session, target_user_id)
     if not target_user:
         await repo.update_ref_withdraw_status(session, req_id, "rejected", {"reason": "user_not_found"})
-        await session.commit()
         await call.answer("Пользователь не найден", show_alert=True)
         return
 
-    if action == "approve":
-        wallet = await repo.get_referral_wallet(session, target_user_id)
-        if wallet < 500:
-            await repo.update_ref_withdraw_status(session, req_id, "rejected", {"reason": "insufficient_wallet"})
-            await session.commit()
+    def notify_user(text: str) -> None:
+        async def send():
             await edit_screen_by_user(
                 bot,
                 target_user["chat_id"],
                 session,
                 target_user["tg_user_id"],
-                "❌ Заявка отклонена: недостаточно средств для вывода.",
+                text,
                 reply_markup=profile_back_kb(),
             )
+
+        session.after_commit(send)
+
+    if action == "approve":
+        wallet = await repo.get_referral_wallet(session, target_user_id)
+        if wallet < 500:
+            await repo.update_ref_withdraw_status(session, req_id, "rejected", {"reason": "insufficient_wallet"})
+            notify_user("❌ Заявка отклонена: недостаточно средств для вывода.")
             await call.answer("Недостаточно средств", show_alert=True)
         else:
             amount = min(wallet, int(req.get("amount") or wallet))
@@ -716,28 +702,12 @@ async def ref_withdraw_admin(call: CallbackQuery, session: AsyncSession, bot):
             )
             await repo.clear_referral_wallet(session, target_user_id)
             await repo.update_ref_withdraw_status(session, req_id, "approved", {"amount": amount})
-            await session.commit()
-            await edit_screen_by_user(
-                bot,
-                target_user["chat_id"],
-                session,
-                target_user["tg_user_id"],
-                "✅ <b>Заявка одобрена</b>\n\n" f"💰 <b>Зачислено:</b> {amount} ₽\n" f"📊 <b>Текущий баланс:</b> {new_balance} ₽",
-                reply_markup=profile_back_kb(),
-            )
+            notify_user("✅ <b>Заявка одобрена</b>\n\n" f"💰 <b>Зачислено:</b> {amount} ₽\n" f"📊 <b>Текущий баланс:</b> {new_balance} ₽")
             await call.answer("Заявка одобрена")
 
     elif action == "reject":
         await repo.update_ref_withdraw_status(session, req_id, "rejected", {"reason": "rejected_by_admin"})
-        await session.commit()
-        await edit_screen_by_user(
-            bot,
-            target_user["chat_id"],
-            session,
-            target_user["tg_user_id"],
-            "❌ <b>Заявка отклонена.</b>\n\nЕсли это ошибка — обратитесь в поддержку.",
-            reply_markup=profile_back_kb(),
-        )
+        notify_user("❌ <b>Заявка отклонена.</b>\n\nЕсли это ошибка — обратитесь в поддержку.")
         await call.answer("Заявка отклонена")
     else:
         await call.answer("Неизвестное действие", show_alert=True)
@@ -1,10 +1,20 @@
 ﻿from __future__ import annotations
 
+import hashlib
+import time
+
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..services import repo
+from ..config import settings
+from ..services import metrics, repo
+
+edits_skipped = metrics.counter("screen_edits_skipped_total", "Screen edits skipped because the content was unchanged")
+edit_hits = metrics.counter("screen_edit_hits_total", "Screen edits accepted by Telegram")
+edit_misses = metrics.counter("screen_edit_misses_total", "Screen edits rejected by Telegram")
+edits_expired = metrics.counter("screen_edits_expired_total", "Screen edits not attempted because the message left the edit window")
+edit_fallbacks = metrics.counter("screen_edit_fallbacks_total", "Screens sent as a new message instead of an edit")
 
 
 def _build_kwargs(text: str, reply_markup, parse_mode, disable_web_page_preview):
@@ -16,6 +26,22 @@ def _build_kwargs(text: str, reply_markup, parse_mode, disable_web_page_preview)
     return kwargs
 
 
+def _fingerprint(text: str, reply_markup, parse_mode, disable_web_page_preview) -> str:
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else ""
+    raw = "\x1f".join((text, markup, str(parse_mode), str(disable_web_page_preview)))
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _editable(sent_at) -> bool:
+    # unknown age (screens stored before sent_at was tracked) is worth one attempt
+    if not settings.screen_edit_window or sent_at is None:
+        return True
+    if time.time() - float(sent_at) < settings.screen_edit_window:
+        return True
+    edits_expired.inc()
+    return False
+
+
 async def _try_edit(bot, chat_id: int, message_id: int, text: str, reply_markup, parse_mode, disable_web_page_preview) -> bool:
     try:
         await bot.edit_message_text(
@@ -23,12 +49,15 @@ async def _try_edit(bot, chat_id: int, message_id: int, text: str, reply_markup,
             message_id=message_id,
             **_build_kwargs(text, reply_markup, parse_mode, disable_web_page_preview),
         )
+        edit_hits.inc()
         return True
     except TelegramBadRequest as exc:
         if "message is not modified" in str(exc):
+            edit_hits.inc()
             return True
     except Exception:
         pass
+    edit_misses.inc()
     return False
 
 
@@ -46,25 +75,40 @@ async def edit_screen(
     state = (user or {}).get("state") or "menu"
     ui = ((user or {}).get("payload") or {}).get("ui") or {}
     stored_id = ui.get("screen_message_id")
+    fingerprint = _fingerprint(text, reply_markup, parse_mode, disable_web_page_preview)
+    # a button press on the stored screen proves it still shows what we last rendered
+    on_screen = bool(stored_id) and message.from_user and message.from_user.is_bot and message.message_id == int(stored_id)
+    if on_screen and ui.get("screen_hash") == fingerprint:
+        edits_skipped.inc()
+        return int(stored_id)
 
-    candidate_ids = []
-    if stored_id:
-        candidate_ids.append(int(stored_id))
-    if message.from_user and message.from_user.is_bot:
-        if message.message_id not in candidate_ids:
-            candidate_ids.append(message.message_id)
+    # message_id -> unix time it was sent
+    candidates = {}
+    if stored_id and _editable(ui.get("screen_sent_at")):
+        candidates[int(stored_id)] = ui.get("screen_sent_at")
+    if message.from_user and message.from_user.is_bot and message.message_id not in candidates:
+        sent_at = message.date.timestamp() if message.date else None
+        if _editable(sent_at):
+            candidates[message.message_id] = sent_at
 
-    for candidate_id in candidate_ids:
+    for candidate_id, sent_at in candidates.items():
         if await _try_edit(message.bot, message.chat.id, candidate_id, text, reply_markup, parse_mode, disable_web_page_preview):
-            if stored_id != candidate_id and user:
-                await repo.set_state_payload(session, user_id, state, "ui", {"screen_message_id": candidate_id})
-                await session.commit()
+            if user:
+                await repo.set_state_payload(session, user_id, state, "ui", {
+                    "screen_message_id": candidate_id,
+                    "screen_hash": fingerprint,
+                    "screen_sent_at": sent_at,
+                })
             return candidate_id
 
+    edit_fallbacks.inc()
     sent = await message.answer(**_build_kwargs(text, reply_markup, parse_mode, disable_web_page_preview))
     if user:
-        await repo.set_state_payload(session, user_id, state, "ui", {"screen_message_id": sent.message_id})
-        await session.commit()
+        await repo.set_state_payload(session, user_id, state, "ui", {
+            "screen_message_id": sent.message_id,
+            "screen_hash": fingerprint,
+            "screen_sent_at": int(time.time()),
+        })
     return sent.message_id
 
 
@@ -82,13 +126,20 @@ async def edit_screen_by_user(
     state = (user or {}).get("state") or "menu"
     ui = ((user or {}).get("payload") or {}).get("ui") or {}
     stored_id = ui.get("screen_message_id")
+    fingerprint = _fingerprint(text, reply_markup, parse_mode, disable_web_page_preview)
 
-    if stored_id:
+    if stored_id and _editable(ui.get("screen_sent_at")):
         if await _try_edit(bot, chat_id, int(stored_id), text, reply_markup, parse_mode, disable_web_page_preview):
+            if user:
+                await repo.set_state_payload(session, tg_user_id, state, "ui", {"screen_hash": fingerprint})
             return int(stored_id)
 
+    edit_fallbacks.inc()
     sent = await bot.send_message(chat_id, **_build_kwargs(text, reply_markup, parse_mode, disable_web_page_preview))
     if user:
-        await repo.set_state_payload(session, tg_user_id, state, "ui", {"screen_message_id": sent.message_id})
-        await session.commit()
+        await repo.set_state_payload(session, tg_user_id, state, "ui", {
+            "screen_message_id": sent.message_id,
+            "screen_hash": fingerprint,
+            "screen_sent_at": int(time.time()),
+        })
     return sent.message_id
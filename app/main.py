@@ -1,25 +1,77 @@
 ﻿import asyncio
+import signal
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
-from sqlalchemy.ext.asyncio import AsyncSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 from .config import settings
-from .db import SessionLocal
+from .db import LazySession
 from .handlers import menu, buy, payment, config, balance, profile, fallback
+from .services import catalog, fanout, image_pipeline, metrics, settings_cache
+from .services.jobs import register_jobs
+from .services.migrations import apply_migrations
+from .services.outbound import OutboundMiddleware, outbound_scheduler
+from .services.pg_listener import pg_listener
+from .services.scheduler import scheduler
+from .services.user_context import UserContext
 
 
 dp = Dispatcher(storage=MemoryStorage())
 
+updates_total = metrics.counter("bot_updates_total", "Updates dispatched")
+updates_without_db = metrics.counter("bot_updates_without_db_total", "Updates served without a DB session checkout")
+
 
 def register_middlewares(dp: Dispatcher):
     @dp.update.middleware()
     async def db_session_middleware(handler, event, data):
-        async with SessionLocal() as session:  # type: AsyncSession
-            data["session"] = session
-            return await handler(event, data)
+        session = LazySession()
+        user_ctx = UserContext()
+        session.info["user_ctx"] = user_ctx
+        data["session"] = session
+        data["user_ctx"] = user_ctx
+        updates_total.inc()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            await session.rollback()
+            raise
+        else:
+            await session.commit()
+            return result
+        finally:
+            if session.opened:
+                await session.close()
+            else:
+                updates_without_db.inc()
+
+
+def register_lifecycle(dp: Dispatcher):
+    pg_listener.subscribe(settings_cache.CHANNEL, settings_cache.settings_cache.invalidate)
+    pg_listener.subscribe(catalog.CHANNEL, catalog.catalog_cache.invalidate)
+    register_jobs(scheduler)
+
+    async def on_startup():
+        if settings.run_migrations:
+            await apply_migrations()
+        await pg_listener.start()
+        await scheduler.start()
+
+    async def on_shutdown():
+        # updates have stopped; let fan-outs finish (they queue log rows) before
+        # the scheduler's final flushes, and keep outbound sends alive until then
+        await pg_listener.stop()
+        await fanout.drain()
+        await scheduler.stop()
+        await outbound_scheduler.stop()
+        image_pipeline.shutdown()
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
 
 def register_handlers(dp: Dispatcher):
@@ -32,19 +84,89 @@ def register_handlers(dp: Dispatcher):
     dp.include_router(fallback.router)
 
 
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def run_polling(bot: Bot):
+    runner = None
+    if settings.metrics_port:
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_view)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host=settings.webhook_host, port=settings.metrics_port).start()
+    await bot.delete_webhook(drop_pending_updates=False)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if runner:
+            await runner.cleanup()
+
+
+async def run_webhook(bot: Bot):
+    if not settings.webhook_base_url:
+        raise RuntimeError("WEBHOOK_BASE_URL is required when BOT_MODE=webhook")
+    if not settings.webhook_secret:
+        raise RuntimeError("WEBHOOK_SECRET is required when BOT_MODE=webhook")
+
+    async def on_startup(bot: Bot):
+        await bot.set_webhook(
+            settings.webhook_base_url.rstrip("/") + settings.webhook_path,
+            secret_token=settings.webhook_secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    async def healthz(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    dp.startup.register(on_startup)
+
+    app = web.Application()
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics_view)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.webhook_secret,
+    ).register(app, path=settings.webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=settings.webhook_host, port=settings.webhook_port)
+    await site.start()
+    # docker stop / a rolling deploy sends SIGTERM to PID 1; cleanup runs the dispatcher shutdown
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
+
+
 async def main():
     bot = Bot(
         token=settings.bot_token,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
+    bot.session.middleware(OutboundMiddleware(outbound_scheduler))
     register_middlewares(dp)
     register_handlers(dp)
+    register_lifecycle(dp)
 
     await bot.set_my_commands([
         BotCommand(command="start", description="Меню"),
     ])
 
-    await dp.start_polling(bot)
+    if settings.bot_mode == "webhook":
+        await run_webhook(bot)
+    else:
+        await run_polling(bot)
 
 
 if __name__ == "__main__":
@@ -116,6 +116,7 @@ class TgSession(Base):
     state: Mapped[str] = mapped_column(Text, default="menu")
     payload: Mapped[dict] = mapped_column(JSON, default=dict)
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
+    version: Mapped[int] = mapped_column(BigInteger, default=0)
 
 
 class Plan(Base):
@@ -157,7 +158,10 @@ class PaymentProof(Base):
     file_name: Mapped[str | None] = mapped_column(Text)
     mime_type: Mapped[str | None] = mapped_column(Text)
     file_size: Mapped[int | None] = mapped_column(Integer)
-    file_data: Mapped[bytes] = mapped_column()
+    file_data: Mapped[bytes | None] = mapped_column()
+    blob_sha256: Mapped[str | None] = mapped_column(Text)
+    thumb_sha256: Mapped[str | None] = mapped_column(Text)
+    original_sha256: Mapped[str | None] = mapped_column(Text)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=datetime.utcnow)
 
 
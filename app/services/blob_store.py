@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import AsyncIterable, BinaryIO
+
+from ..config import settings
+from . import metrics
+
+blobs_written = metrics.counter("blob_store_writes_total", "Blobs written to the blob store")
+blobs_deduplicated = metrics.counter("blob_store_dedup_total", "Uploads that matched an existing blob")
+
+
+class BlobTooLarge(ValueError):
+    pass
+
+
+class BlobStore(ABC):
+    """Content-addressed storage for uploaded files, keyed by SHA-256 hex digest."""
+
+    @abstractmethod
+    async def put(self, data: bytes) -> str:
+        ...
+
+    @abstractmethod
+    async def spool(self, chunks: AsyncIterable[bytes], max_size: int) -> tuple[Path, str, int]:
+        """Write chunks to a local temp file; the caller adopt()s or unlinks it."""
+
+    @abstractmethod
+    def adopt(self, tmp: Path, sha256: str) -> None:
+        ...
+
+    @abstractmethod
+    def exists(self, sha256: str) -> bool:
+        ...
+
+    @abstractmethod
+    def path(self, sha256: str) -> Path:
+        ...
+
+
+class FilesystemBlobStore(BlobStore):
+    """Blobs under root/ab/cd/<sha256>; writes land in a temp file and are renamed into place."""
+
+    def __init__(self, root: str | os.PathLike) -> None:
+        self.root = Path(root)
+
+    def path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256[2:4] / sha256
+
+    def exists(self, sha256: str) -> bool:
+        return self.path(sha256).exists()
+
+    async def put(self, data: bytes) -> str:
+        return await asyncio.to_thread(self._put, data)
+
+    async def spool(self, chunks: AsyncIterable[bytes], max_size: int) -> tuple[Path, str, int]:
+        spool_dir = self.root / ".spool"
+        spool_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=spool_dir)
+        fh = os.fdopen(fd, "wb")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise BlobTooLarge(size)
+                digest.update(chunk)
+                await asyncio.to_thread(fh.write, chunk)
+            await asyncio.to_thread(self._seal, fh)
+        except BaseException:
+            fh.close()
+            os.unlink(tmp)
+            raise
+        return Path(tmp), digest.hexdigest(), size
+
+    def adopt(self, tmp: Path, sha256: str) -> None:
+        target = self.path(sha256)
+        if target.exists():
+            tmp.unlink(missing_ok=True)
+            blobs_deduplicated.inc()
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, target)
+        blobs_written.inc()
+
+    @staticmethod
+    def _seal(fh: BinaryIO) -> None:
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+
+    def _put(self, data: bytes) -> str:
+        sha256 = hashlib.sha256(data).hexdigest()
+        target = self.path(sha256)
+        if target.exists():
+            blobs_deduplicated.inc()
+            return sha256
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, target)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        blobs_written.inc()
+        return sha256
+
+
+blob_store: BlobStore = FilesystemBlobStore(settings.blob_store_path)
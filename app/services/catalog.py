@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import time
+from typing import Any
+
+from ..config import settings
+
+CHANNEL = "catalog_changed"
+
+
+class CatalogCache:
+    """plans and vpn_servers rows, dropped on TTL or NOTIFY (payload is the table name)."""
+
+    def __init__(self, ttl: float) -> None:
+        self._ttl = ttl
+        self._plans: tuple[float, list[dict[str, Any]], dict[int, dict[str, Any]]] | None = None
+        self._servers: tuple[float, list[dict[str, Any]]] | None = None
+
+    def plans(self) -> list[dict[str, Any]] | None:
+        """Enabled plans in display order, or None when the cache is cold."""
+        if self._plans is None or self._plans[0] < time.monotonic():
+            return None
+        return [dict(p) for p in self._plans[1]]
+
+    def plan(self, plan_id: int, default: Any = None) -> Any:
+        """Any plan by id, disabled ones included; default when the cache is cold."""
+        if self._plans is None or self._plans[0] < time.monotonic():
+            return default
+        row = self._plans[2].get(plan_id)
+        return dict(row) if row else None
+
+    def servers(self) -> list[dict[str, Any]] | None:
+        if self._servers is None or self._servers[0] < time.monotonic():
+            return None
+        return [dict(s) for s in self._servers[1]]
+
+    def put_plans(self, rows: list[dict[str, Any]]) -> None:
+        enabled = [r for r in rows if r.get("enabled")]
+        enabled.sort(key=lambda r: (r["price_minor"], r["id"]))
+        self._plans = (time.monotonic() + self._ttl, enabled, {r["id"]: r for r in rows})
+
+    def put_servers(self, rows: list[dict[str, Any]]) -> None:
+        self._servers = (time.monotonic() + self._ttl, rows)
+
+    def invalidate(self, table: str | None = None) -> None:
+        if table in (None, "plans"):
+            self._plans = None
+        if table in (None, "vpn_servers"):
+            self._servers = None
+
+
+catalog_cache = CatalogCache(settings.catalog_cache_ttl)
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Iterable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..db import SessionLocal
+from . import metrics, outbound, repo
+
+logger = logging.getLogger(__name__)
+
+deliveries_total = metrics.counter("fanout_deliveries_total", "Fan-out messages delivered")
+failures_total = metrics.counter("fanout_failures_total", "Fan-out messages that failed")
+
+_tasks: set[asyncio.Task] = set()
+
+
+def fan_out(
+    action: str,
+    recipients: Iterable[int],
+    send: Callable[[int], Awaitable[Any]],
+    context: dict | None = None,
+    on_delivered: Callable[[AsyncSession, dict[str, int | None]], Awaitable[None]] | None = None,
+) -> asyncio.Task:
+    """Send to every recipient concurrently in the background on the ADMIN lane.
+
+    on_delivered(session, delivered) runs in the transaction that logs the results.
+    """
+    task = asyncio.create_task(_deliver(action, list(dict.fromkeys(recipients)), send, context or {}, on_delivered))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def drain(timeout: float = 10.0) -> None:
+    # a finishing fan-out can start another (moderation cleanup), so wait until none are left
+    deadline = asyncio.get_running_loop().time() + timeout
+    while _tasks:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            logger.warning("%d fan-outs still running at shutdown", len(_tasks))
+            return
+        await asyncio.wait(set(_tasks), timeout=remaining)
+
+
+async def _deliver(
+    action: str,
+    recipients: list[int],
+    send: Callable[[int], Awaitable[Any]],
+    context: dict,
+    on_delivered: Callable[[AsyncSession, dict[str, int | None]], Awaitable[None]] | None,
+) -> None:
+    if not recipients:
+        return
+    with outbound.lane(outbound.ADMIN):
+        results = await asyncio.gather(*(send(r) for r in recipients), return_exceptions=True)
+
+    # recipient -> sent message_id (kept so the messages can be cleaned up later)
+    delivered: dict[str, int | None] = {}
+    failed: dict[str, str] = {}
+    for recipient, result in zip(recipients, results):
+        if isinstance(result, BaseException):
+            failed[str(recipient)] = f"{type(result).__name__}: {result}"
+        else:
+            delivered[str(recipient)] = getattr(result, "message_id", None)
+    deliveries_total.inc(len(delivered))
+    failures_total.inc(len(failed))
+
+    try:
+        async with SessionLocal() as session:
+            await repo.log_event(
+                session,
+                "admin_actions",
+                "error" if failed else "info",
+                None,
+                None,
+                action,
+                f"{len(delivered)}/{len(recipients)} delivered",
+                {**context, "delivered": delivered, "failed": failed},
+            )
+            if on_delivered is not None:
+                await on_delivered(session, delivered)
+            await session.commit()
+    except Exception:
+        logger.exception("failed to record %s fan-out results", action)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from ..config import settings
+from . import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; proofs are then stored as uploaded
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+images_normalized = metrics.counter("proof_images_normalized_total", "Proof images re-encoded by the pipeline")
+images_failed = metrics.counter("proof_images_failed_total", "Proof images the pipeline could not decode")
+bytes_saved = metrics.counter("proof_image_bytes_saved_total", "Bytes saved by re-encoding proof images")
+normalize_seconds = metrics.histogram("proof_image_normalize_seconds", "Wall time of one proof image normalization")
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def enabled() -> bool:
+    return Image is not None and settings.proof_normalize_images
+
+
+def _encode(image, max_side: int, quality: int) -> bytes:
+    image = image.copy()
+    image.thumbnail((max_side, max_side))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def _dhash(image) -> int:
+    # 64-bit difference hash: one bit per horizontally adjacent pair of a 9x8 greyscale copy
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def _open(path: str, max_pixels: int, side: int):
+    # the header is enough to refuse a decompression bomb before any pixels are decoded
+    source = Image.open(path)
+    width, height = source.size
+    if width * height > max_pixels:
+        source.close()
+        raise ValueError(f"{width}x{height} exceeds {max_pixels} pixels")
+    # JPEG can decode straight at a reduced scale that still covers side
+    source.draft("RGB", (side, side))
+    return source
+
+
+def _normalize(path: str, max_side: int, quality: int, thumb_side: int, thumb_quality: int, max_pixels: int) -> tuple[bytes, bytes, int]:
+    # runs in a worker process: decoding and resampling must stay off the event loop
+    with _open(path, max_pixels, max_side) as source:
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    return _encode(image, max_side, quality), _encode(image, thumb_side, thumb_quality), _dhash(image)
+
+
+def _fingerprint(path: str, max_side: int, max_pixels: int) -> int:
+    with _open(path, max_pixels, max_side) as source:
+        return _dhash(ImageOps.exif_transpose(source))
+
+
+async def _run(func, *args):
+    global _executor
+    if _executor is None:
+        # spawn: forking a process that already runs threads (asyncio.to_thread) can hand
+        # the workers locks that are held forever
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.proof_image_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+async def normalize(path: Path) -> tuple[bytes, bytes, int] | None:
+    """Re-encoded image, thumbnail and dHash, or None if the file can't be decoded."""
+    started = time.monotonic()
+    try:
+        image, thumb, dhash = await _run(
+            _normalize,
+            str(path),
+            settings.proof_image_max_side,
+            settings.proof_image_quality,
+            settings.proof_thumb_side,
+            settings.proof_thumb_quality,
+            settings.proof_image_max_pixels,
+        )
+    except Exception:
+        images_failed.inc()
+        logger.warning("proof image %s could not be normalized", path.name, exc_info=True)
+        return None
+    normalize_seconds.observe(time.monotonic() - started)
+    images_normalized.inc()
+    bytes_saved.inc(max(path.stat().st_size - len(image), 0))
+    return image, thumb, dhash
+
+
+async def fingerprint(path: Path) -> int | None:
+    """dHash of an image file without re-encoding it; None without Pillow or for non-images."""
+    if Image is None:
+        return None
+    try:
+        return await _run(_fingerprint, str(path), settings.proof_image_max_side, settings.proof_image_max_pixels)
+    except Exception:
+        logger.warning("proof image %s could not be fingerprinted", path.name, exc_info=True)
+        return None
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
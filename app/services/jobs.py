@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from ..config import settings
+from ..db import SessionLocal
+from . import metrics, repo
+from .last_seen import last_seen, rows_flushed as last_seen_rows_flushed
+from .log_queue import entries_written, log_queue
+from .scheduler import Scheduler
+from .session_store import rows_conflicted, rows_flushed, session_store
+
+logger = logging.getLogger(__name__)
+
+referral_settled_total = metrics.counter("referral_settled_total", "Referral bonuses credited to wallets")
+referral_settle_rate = metrics.gauge("referral_settle_rows_per_second", "Throughput of the last settlement run")
+server_load_drift_total = metrics.counter("server_load_drift_total", "server_load rows corrected by reconciliation")
+
+
+async def settle_referral_bonuses() -> None:
+    started = time.perf_counter()
+    total = 0
+    after_id = 0
+    while True:
+        async with SessionLocal() as session:
+            claimed, settled, after_id = await repo.settle_referral_batch(
+                session, limit=settings.referral_settle_batch, after_id=after_id
+            )
+            await session.commit()
+        total += settled
+        if claimed < settings.referral_settle_batch:
+            break
+    if total:
+        elapsed = time.perf_counter() - started
+        rate = total / elapsed if elapsed > 0 else float(total)
+        referral_settled_total.inc(total)
+        referral_settle_rate.set(rate)
+        logger.info("settled %d referral bonuses in %.2fs (%.0f rows/s)", total, elapsed, rate)
+
+
+async def flush_session_state() -> None:
+    rows = session_store.take_dirty()
+    if not rows:
+        return
+    try:
+        async with SessionLocal() as session:
+            written = await repo.write_sessions(session, rows)
+            await session.commit()
+    except Exception:
+        session_store.restore_dirty([r["tg_user_id"] for r in rows])
+        raise
+    conflicts = []
+    for row in rows:
+        if row["tg_user_id"] in written:
+            session_store.flushed(row["tg_user_id"], row["version"], written[row["tg_user_id"]])
+        else:
+            session_store.conflicted(row["tg_user_id"], row["version"])
+            conflicts.append(row)
+    rows_flushed.inc(len(written))
+    if conflicts:
+        # the row changed elsewhere (write-through, or another replica without sticky routing)
+        rows_conflicted.inc(len(conflicts))
+        logger.warning(
+            "dropped %d buffered session writes that lost to a newer tg_sessions row: %s",
+            len(conflicts),
+            ", ".join(f"{r['tg_user_id']}:{r['state']}" for r in conflicts[:20]),
+        )
+
+
+async def flush_last_seen() -> None:
+    pending = last_seen.take()
+    if not pending:
+        return
+    try:
+        async with SessionLocal() as session:
+            updated = await repo.write_last_seen(session, pending)
+            await session.commit()
+    except Exception:
+        last_seen.restore(pending)
+        raise
+    last_seen_rows_flushed.inc(updated)
+
+
+async def flush_logs() -> None:
+    # only what is queued now, so a steady inflow can't keep the job running
+    remaining = len(log_queue)
+    while remaining > 0:
+        batch = log_queue.take(min(settings.log_flush_batch, remaining))
+        remaining -= len(batch)
+        try:
+            async with SessionLocal() as session:
+                await repo.write_logs(session, batch)
+                await session.commit()
+        except Exception:
+            log_queue.restore(batch)
+            raise
+        entries_written.inc(len(batch))
+
+
+async def reconcile_server_load() -> None:
+    async with SessionLocal() as session:
+        drift = await repo.reconcile_server_load(session)
+        await session.commit()
+    if drift:
+        server_load_drift_total.inc(drift)
+        logger.warning("server_load drifted on %d servers, corrected", drift)
+
+
+def register_jobs(scheduler: Scheduler) -> None:
+    scheduler.add_job(
+        "referral_settlement",
+        settle_referral_bonuses,
+        interval=settings.referral_settle_interval,
+        jitter=settings.scheduler_jitter,
+        leader=True,
+    )
+    scheduler.add_job(
+        "server_load_reconcile",
+        reconcile_server_load,
+        interval=settings.server_load_reconcile_interval,
+        jitter=settings.scheduler_jitter,
+        leader=True,
+    )
+    scheduler.add_job(
+        "last_seen_flush",
+        flush_last_seen,
+        interval=settings.last_seen_flush_interval,
+        run_on_stop=True,
+    )
+    scheduler.add_job(
+        "log_flush",
+        flush_logs,
+        interval=settings.log_flush_interval,
+        run_on_stop=True,
+    )
+    if settings.session_write_back:
+        scheduler.add_job(
+            "session_flush",
+            flush_session_state,
+            interval=settings.session_flush_interval,
+            run_on_stop=True,
+        )
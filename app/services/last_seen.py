@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from . import metrics
+
+touches_buffered = metrics.counter("last_seen_touches_total", "last_seen_at touches absorbed in memory")
+rows_flushed = metrics.counter("last_seen_rows_flushed_total", "tg_users rows updated by the last_seen flusher")
+
+
+class LastSeenBuffer:
+    """Latest activity time per tg_user_id, written to tg_users in batches."""
+
+    def __init__(self) -> None:
+        self._pending: dict[int, datetime] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def touch(self, tg_user_id: int) -> None:
+        self._pending[tg_user_id] = datetime.now(timezone.utc)
+        touches_buffered.inc()
+
+    def take(self) -> dict[int, datetime]:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending: dict[int, datetime]) -> None:
+        for tg_user_id, seen_at in pending.items():
+            current = self._pending.get(tg_user_id)
+            if current is None or current < seen_at:
+                self._pending[tg_user_id] = seen_at
+
+
+last_seen = LastSeenBuffer()
+metrics.gauge("last_seen_pending", "Buffered last_seen_at touches", lambda: len(last_seen))
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import Any
+
+from ..config import settings
+from . import metrics
+
+# Audit trail for money and admin decisions: kept even past capacity.
+PROTECTED_CATEGORIES = frozenset({"payments", "admin_actions"})
+LEVEL_RANK = {"debug": 0, "info": 1, "warning": 2, "error": 3}
+
+entries_queued = metrics.counter("log_entries_queued_total", "log_event entries queued for the batch writer")
+entries_dropped = metrics.counter("log_entries_dropped_total", "log_event entries dropped because the queue was full")
+entries_written = metrics.counter("log_entries_written_total", "log_event entries written to the logs table")
+
+
+class LogQueue:
+    """Bounded buffer of logs rows; when full, the least important unprotected row goes first."""
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._items: deque[dict[str, Any]] = deque()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, entry: dict[str, Any]) -> bool:
+        if len(self._items) >= self._capacity and not self._make_room(entry):
+            entries_dropped.inc()
+            return False
+        self._items.append(entry)
+        entries_queued.inc()
+        return True
+
+    def take(self, limit: int) -> list[dict[str, Any]]:
+        batch = []
+        while self._items and len(batch) < limit:
+            batch.append(self._items.popleft())
+        return batch
+
+    def restore(self, batch: list[dict[str, Any]]) -> None:
+        self._items.extendleft(reversed(batch))
+
+    def _make_room(self, entry: dict[str, Any]) -> bool:
+        protected = entry["category"] in PROTECTED_CATEGORIES
+        rank = LEVEL_RANK.get(entry["level"], 1)
+        victim = None
+        victim_rank = rank if not protected else len(LEVEL_RANK)
+        for i, item in enumerate(self._items):
+            if item["category"] in PROTECTED_CATEGORIES:
+                continue
+            item_rank = LEVEL_RANK.get(item["level"], 1)
+            if item_rank < victim_rank:
+                victim, victim_rank = i, item_rank
+                if item_rank == 0:
+                    break
+        if victim is not None:
+            del self._items[victim]
+            entries_dropped.inc()
+            return True
+        return protected
+
+
+log_queue = LogQueue(settings.log_queue_capacity)
+metrics.gauge("log_queue_depth", "log_event entries waiting to be written", lambda: len(log_queue))
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from typing import Callable
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {self.value}"]
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str, fn: Callable[[], float] | None = None) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.value = 0.0
+        self._fn = fn
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def get(self) -> float:
+        return self._fn() if self._fn else self.value
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {self.get()}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, cnt in zip(self.buckets, self.counts):
+            cumulative += cnt
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+_registry: dict[str, Counter | Gauge | Histogram] = {}
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def counter(name: str, help_text: str) -> Counter:
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = Counter(name, help_text)
+    return metric
+
+
+def gauge(name: str, help_text: str, fn: Callable[[], float] | None = None) -> Gauge:
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = Gauge(name, help_text, fn)
+    return metric
+
+
+def histogram(name: str, help_text: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = Histogram(name, help_text, buckets)
+    return metric
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry.values():
+        kind = type(metric).__name__.lower()
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
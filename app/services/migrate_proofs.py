@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+
+from ..db import SessionLocal
+from . import repo
+from .blob_store import blob_store
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate_proofs(batch_size: int = 100) -> int:
+    """Move payment_proofs.file_data into the blob store, one committed batch at a time."""
+    moved = 0
+    while True:
+        async with SessionLocal() as session:
+            rows = await repo.claim_inline_proofs(session, batch_size)
+            if not rows:
+                break
+            done = []
+            for row in rows:
+                sha256 = await blob_store.put(bytes(row["file_data"]))
+                done.append({"id": row["id"], "blob_sha256": sha256})
+            await repo.set_proof_blobs(session, done)
+            await session.commit()
+        moved += len(done)
+        logger.info("moved %d proofs (%d total)", len(done), moved)
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move payment proof bytes from Postgres to the blob store")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(migrate_proofs(args.batch_size)))
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import re
+from pathlib import Path
+
+import asyncpg
+
+from ..db import asyncpg_dsn
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).resolve().parents[2] / "migrations"
+# Only NNN_name.sql files are versioned; one-off data scripts without a
+# numeric prefix (migrate_bot_settings_to_tables.sql) stay manual.
+VERSION_RE = re.compile(r"^(\d+)_[\w.-]+\.sql$")
+LOCK_KEY = 7_356_001
+
+
+def discover(directory: Path = MIGRATIONS_DIR) -> list[tuple[int, Path]]:
+    found = []
+    for path in directory.glob("*.sql"):
+        match = VERSION_RE.match(path.name)
+        if match:
+            found.append((int(match.group(1)), path))
+    found.sort()
+    versions = [v for v, _ in found]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"duplicate migration versions in {directory}")
+    return found
+
+
+async def apply_migrations(directory: Path = MIGRATIONS_DIR) -> list[str]:
+    conn = await asyncpg.connect(asyncpg_dsn())
+    applied_now = []
+    try:
+        # replicas starting together wait here instead of racing on DDL
+        await conn.execute("select pg_advisory_lock($1)", LOCK_KEY)
+        await conn.execute(
+            """
+            create table if not exists schema_migrations (
+                version integer primary key,
+                name text not null,
+                checksum text not null,
+                applied_at timestamptz not null default now()
+            );
+            """
+        )
+        rows = await conn.fetch("select version, name, checksum from schema_migrations")
+        applied = {r["version"]: r for r in rows}
+        for version, path in discover(directory):
+            sql = path.read_text(encoding="utf-8-sig")
+            checksum = hashlib.sha256(sql.encode("utf-8")).hexdigest()
+            done = applied.get(version)
+            if done is not None:
+                if done["checksum"] != checksum:
+                    raise RuntimeError(
+                        f"migration {path.name} was modified after being applied as {done['name']}"
+                    )
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "insert into schema_migrations (version, name, checksum) values ($1, $2, $3)",
+                    version,
+                    path.name,
+                    checksum,
+                )
+            logger.info("applied migration %s", path.name)
+            applied_now.append(path.name)
+    finally:
+        try:
+            await conn.execute("select pg_advisory_unlock($1)", LOCK_KEY)
+        finally:
+            await conn.close()
+    return applied_now
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for name in asyncio.run(apply_migrations()):
+        print(name)
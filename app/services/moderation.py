@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+from typing import Any
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from . import metrics, repo
+from .fanout import fan_out
+
+items_claimed = metrics.counter("moderation_items_claimed_total", "Moderation items claimed by an admin")
+claims_contended = metrics.counter("moderation_claims_contended_total", "Admin actions on an item another admin was holding")
+items_resolved = metrics.counter("moderation_items_resolved_total", "Moderation items closed")
+
+
+async def claim(session: AsyncSession, order_id: int, admin_id: int) -> bool:
+    """Take the order's item for this admin; False if another admin holds it or it's done."""
+    if await repo.claim_moderation_item(session, order_id, admin_id, settings.moderation_claim_ttl):
+        items_claimed.inc()
+        return True
+    claims_contended.inc()
+    return False
+
+
+async def claim_next(session: AsyncSession, admin_id: int) -> dict[str, Any] | None:
+    item = await repo.claim_next_moderation_item(session, admin_id, settings.moderation_claim_ttl)
+    if item:
+        items_claimed.inc()
+    return item
+
+
+async def resolve(session: AsyncSession, bot, order_id: int, resolution: str, skip: tuple[int, int] | None = None) -> None:
+    """Close the item and, once committed, delete every admin's copy except skip=(chat_id, message_id)."""
+    messages = await repo.finish_moderation_item(session, order_id, resolution)
+    if messages is None:
+        return
+    items_resolved.inc()
+    messages = {chat: [mid for mid in mids if skip is None or (int(chat), mid) != skip] for chat, mids in messages.items()}
+    messages = {chat: mids for chat, mids in messages.items() if mids}
+    if not messages:
+        return
+
+    async def cleanup():
+        _delete_copies(bot, order_id, messages)
+
+    session.after_commit(cleanup)
+
+
+def recorder(bot, order_id: int):
+    """fan_out on_delivered hook that remembers where the copies went."""
+
+    async def record(session: AsyncSession, delivered: dict[str, int | None]) -> None:
+        sent = {chat: mid for chat, mid in delivered.items() if mid}
+        if sent and await repo.add_moderation_messages(session, order_id, sent) == "done":
+            # decided before the copies went out
+            _delete_copies(bot, order_id, {chat: [mid] for chat, mid in sent.items()})
+
+    return record
+
+
+def _delete_copies(bot, order_id: int, messages: dict[str, list[int]]) -> None:
+    targets = {int(chat): mids for chat, mids in messages.items()}
+
+    async def delete(chat_id: int):
+        # an admin can hold more than one copy (fan-out plus "next")
+        return await bot.delete_messages(chat_id, targets[chat_id])
+
+    fan_out("payment_proof_cleanup", targets, delete, {"order_id": order_id})
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from ..config import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lower value goes first when the global bucket is the bottleneck.
+USER = 0
+ADMIN = 1
+BULK = 2
+
+_lane: ContextVar[int] = ContextVar("outbound_lane", default=USER)
+
+queue_wait_seconds = metrics.histogram("outbound_queue_wait_seconds", "Time a Bot API call waited for a send slot")
+send_seconds = metrics.histogram("outbound_send_seconds", "Bot API call latency once a slot was granted")
+retry_after_total = metrics.counter("outbound_retry_after_total", "RetryAfter (429) responses from the Bot API")
+
+
+@contextlib.contextmanager
+def lane(value: int) -> Iterator[None]:
+    token = _lane.set(value)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.delay(time.monotonic())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class OutboundScheduler:
+    """Grants Bot API send slots under a global and a per-chat token bucket, by lane."""
+
+    def __init__(self) -> None:
+        self._global = TokenBucket(settings.outbound_global_rate, settings.outbound_global_rate)
+        self._chats: dict[Any, TokenBucket] = {}
+        # (lane, seq, chat_id, future)
+        self._waiters: list[tuple[int, int, Any, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, chat_id: Any) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((_lane.get(), next(self._seq), chat_id, fut))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        await fut
+
+    def pause(self, chat_id: Any, seconds: float) -> None:
+        self._bucket(chat_id).pause(seconds)
+        self._wakeup.set()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _bucket(self, chat_id: Any) -> TokenBucket:
+        # re-inserted on every use, so the dict runs from least to most recently used
+        bucket = self._chats.pop(chat_id, None)
+        if bucket is None:
+            if len(self._chats) >= settings.outbound_chat_buckets:
+                self._prune(time.monotonic())
+            # negative ids are groups and channels, which Telegram limits per minute
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(settings.outbound_chat_rate, settings.outbound_chat_burst)
+            else:
+                bucket = TokenBucket(settings.outbound_group_rate, settings.outbound_chat_burst)
+        self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        # a refilled bucket is the same as a new one; past that, drop the least
+        # recently used down to half the cap so the next prune is far off
+        self._chats = {k: b for k, b in self._chats.items() if not b.full(now)}
+        excess = len(self._chats) - settings.outbound_chat_buckets // 2
+        for chat_id in list(itertools.islice(self._chats, max(excess, 0))):
+            del self._chats[chat_id]
+
+    def _dispatch(self) -> float | None:
+        now = time.monotonic()
+        self._waiters = sorted((w for w in self._waiters if not w[3].done()), key=lambda w: (w[0], w[1]))
+        retry = None
+        pending = []
+        for i, waiter in enumerate(self._waiters):
+            wait = self._global.delay(now)
+            if wait > 0:
+                pending.extend(self._waiters[i:])
+                retry = wait if retry is None else min(retry, wait)
+                break
+            bucket = self._bucket(waiter[2])
+            wait = bucket.delay(now)
+            if wait > 0:
+                pending.append(waiter)
+                retry = wait if retry is None else min(retry, wait)
+                continue
+            bucket.take()
+            self._global.take()
+            waiter[3].set_result(None)
+        self._waiters = pending
+        return retry
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                retry = self._dispatch()
+            except Exception:
+                logger.exception("outbound dispatch failed")
+                retry = 1.0
+            if retry is None and not self._waiters:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=retry)
+            except asyncio.TimeoutError:
+                pass
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Routes every chat-addressed Bot API call through the OutboundScheduler."""
+
+    def __init__(self, scheduler: OutboundScheduler) -> None:
+        self._scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            await self._scheduler.acquire(chat_id)
+            granted = time.perf_counter()
+            queue_wait_seconds.observe(granted - started)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as exc:
+                retry_after_total.inc()
+                self._scheduler.pause(chat_id, exc.retry_after)
+                attempt += 1
+                if attempt > settings.outbound_max_retries:
+                    raise
+                logger.warning("RetryAfter %ss for chat %s, retrying", exc.retry_after, chat_id)
+                continue
+            send_seconds.observe(time.perf_counter() - granted)
+            return result
+
+
+outbound_scheduler = OutboundScheduler()
+metrics.gauge("outbound_queue_depth", "Bot API calls waiting for a send slot", lambda: len(outbound_scheduler))
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Callable
+
+import asyncpg
+
+from ..db import asyncpg_dsn
+
+logger = logging.getLogger(__name__)
+
+# Callbacks receive the NOTIFY payload, or None after a (re)connect when
+# notifications may have been missed and everything should be invalidated.
+Callback = Callable[[str | None], None]
+
+
+class PgListener:
+    def __init__(self, keepalive: float = 30.0, retry_delay: float = 5.0) -> None:
+        self._callbacks: dict[str, list[Callback]] = {}
+        self._keepalive = keepalive
+        self._retry_delay = retry_delay
+        self._task: asyncio.Task | None = None
+
+    def subscribe(self, channel: str, callback: Callback) -> None:
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    async def start(self) -> None:
+        if self._task is None and self._callbacks:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _dispatch(self, channel: str, payload: str | None) -> None:
+        for callback in self._callbacks.get(channel, ()):
+            try:
+                callback(payload)
+            except Exception:
+                logger.exception("LISTEN callback failed for %s", channel)
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        self._dispatch(channel, payload or None)
+
+    async def _run(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(asyncpg_dsn())
+                for channel in self._callbacks:
+                    await conn.add_listener(channel, self._on_notify)
+                    self._dispatch(channel, None)
+                while not conn.is_closed():
+                    await asyncio.sleep(self._keepalive)
+                    await conn.execute("select 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("LISTEN connection lost, retrying in %.0fs", self._retry_delay, exc_info=True)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(self._retry_delay)
+
+
+pg_listener = PgListener()
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+from typing import Any
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..db import SessionLocal
+from . import image_pipeline, metrics, repo
+from .blob_store import blob_store
+
+logger = logging.getLogger(__name__)
+
+duplicates_flagged = metrics.counter("payment_proof_duplicates_total", "Payment proofs flagged as likely duplicates")
+
+_MASK = (1 << 64) - 1
+
+
+def _signed(dhash: int) -> int:
+    # Postgres bigint is signed
+    return dhash - (1 << 64) if dhash >= 1 << 63 else dhash
+
+
+def bands(dhash: int) -> list[int]:
+    dhash &= _MASK
+    return [(dhash >> shift) & 0xFFFF for shift in (48, 32, 16, 0)]
+
+
+def fingerprint_row(proof_id: int, order_id: int, sha256: str | None, dhash: int | None) -> dict[str, Any]:
+    row = {"proof_id": proof_id, "order_id": order_id, "sha256": sha256, "dhash": None}
+    row.update({f"band{i}": None for i in range(4)})
+    if dhash is not None:
+        row["dhash"] = _signed(dhash)
+        row.update({f"band{i}": band for i, band in enumerate(bands(dhash))})
+    return row
+
+
+async def find_duplicates(session: AsyncSession, sha256: str, dhash: int | None, order_id: int) -> list[dict[str, Any]]:
+    """Earlier orders whose proof is byte-identical or within proof_duplicate_distance bits of dhash."""
+    matches = await repo.find_proof_fingerprints(
+        session,
+        sha256,
+        _signed(dhash) if dhash is not None else None,
+        bands(dhash) if dhash is not None else None,
+        settings.proof_duplicate_distance,
+        order_id,
+    )
+    if matches:
+        duplicates_flagged.inc()
+    return matches
+
+
+async def backfill(batch_size: int = 100) -> int:
+    """Fingerprint proofs stored before fingerprinting existed, one committed batch at a time."""
+    done_total = 0
+    while True:
+        async with SessionLocal() as session:
+            rows = await repo.claim_unfingerprinted_proofs(session, batch_size)
+            if not rows:
+                break
+            done = []
+            for row in rows:
+                dhash = None
+                # ingest hashes the upload as received; a normalized blob (it has a thumb)
+                # only matches on the dHash unless the original was kept
+                upload_sha256 = row["original_sha256"] or (row["blob_sha256"] if row["thumb_sha256"] is None else None)
+                source = row["original_sha256"] or row["blob_sha256"]
+                if (row["mime_type"] or "").startswith("image/") and blob_store.exists(source):
+                    dhash = await image_pipeline.fingerprint(blob_store.path(source))
+                done.append(fingerprint_row(row["id"], row["order_id"], upload_sha256, dhash))
+            await repo.insert_proof_fingerprints(session, done)
+            await session.commit()
+        done_total += len(done)
+        logger.info("fingerprinted %d proofs (%d total)", len(done), done_total)
+    image_pipeline.shutdown()
+    return done_total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fingerprint payment proofs uploaded before duplicate detection")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(backfill(args.batch_size)))
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import contextlib
+from typing import Any, AsyncIterator
+
+from ..config import settings
+from . import image_pipeline, metrics
+from .blob_store import BlobTooLarge, blob_store
+
+# Leading bytes each allowed type must start with; the declared MIME alone is client-supplied.
+SIGNATURES = {
+    "image/jpeg": lambda head: head.startswith(b"\xff\xd8\xff"),
+    "image/png": lambda head: head.startswith(b"\x89PNG\r\n\x1a\n"),
+    "image/webp": lambda head: head[:4] == b"RIFF" and head[8:12] == b"WEBP",
+    "application/pdf": lambda head: head.startswith(b"%PDF-"),
+}
+
+proofs_rejected = metrics.counter("payment_proofs_rejected_total", "Payment proof uploads rejected by size or type")
+proof_bytes = metrics.histogram(
+    "payment_proof_bytes",
+    "Size of accepted payment proof uploads",
+    (64e3, 256e3, 1e6, 2e6, 5e6, 10e6, 20e6),
+)
+
+
+class ProofRejected(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        # "size" or "type"
+        self.reason = reason
+
+
+def check_declared(mime_type: str | None, file_size: int | None) -> None:
+    if (mime_type or "").lower() not in settings.proof_mime_types:
+        proofs_rejected.inc()
+        raise ProofRejected("type")
+    if file_size and file_size > settings.proof_max_bytes:
+        proofs_rejected.inc()
+        raise ProofRejected("size")
+
+
+async def _checked(chunks: AsyncIterator[bytes], mime_type: str) -> AsyncIterator[bytes]:
+    head = b""
+    matches = SIGNATURES.get(mime_type)
+    async for chunk in chunks:
+        if matches is not None and len(head) < 12:
+            head = (head + chunk)[:12]
+            if len(head) >= 12 and not matches(head):
+                raise ProofRejected("type")
+        yield chunk
+    if matches is not None and len(head) < 12 and not matches(head):
+        raise ProofRejected("type")
+
+
+async def ingest_proof(bot, file_id: str, mime_type: str | None, file_size: int | None) -> dict[str, Any]:
+    """Stream a Telegram file into the blob store, normalizing images when enabled.
+
+    Returns the payment_proofs columns (blob_sha256, file_size, mime_type,
+    thumb_sha256, original_sha256) plus the upload's fingerprint (upload_sha256,
+    dhash), or raises ProofRejected.
+    """
+    mime_type = (mime_type or "").lower()
+    check_declared(mime_type, file_size)
+    tg_file = await bot.get_file(file_id)
+    check_declared(mime_type, tg_file.file_size)
+    stream = bot.session.stream_content(
+        url=bot.session.api.file_url(bot.token, tg_file.file_path),
+        timeout=settings.proof_download_timeout,
+        chunk_size=64 * 1024,
+    )
+    try:
+        async with contextlib.aclosing(stream):
+            tmp, sha256, size = await blob_store.spool(_checked(stream, mime_type), settings.proof_max_bytes)
+    except BlobTooLarge:
+        proofs_rejected.inc()
+        raise ProofRejected("size")
+    except ProofRejected:
+        proofs_rejected.inc()
+        raise
+    proof_bytes.observe(size)
+
+    try:
+        normalized = None
+        dhash = None
+        if mime_type.startswith("image/"):
+            if image_pipeline.enabled():
+                normalized = await image_pipeline.normalize(tmp)
+            else:
+                dhash = await image_pipeline.fingerprint(tmp)
+        stored = {
+            "blob_sha256": sha256,
+            "file_size": size,
+            "mime_type": mime_type,
+            "thumb_sha256": None,
+            "original_sha256": None,
+            "upload_sha256": sha256,
+            "dhash": dhash,
+        }
+        if normalized is None:
+            blob_store.adopt(tmp, sha256)
+            return stored
+        image, thumb, stored["dhash"] = normalized
+        stored["thumb_sha256"] = await blob_store.put(thumb)
+        if len(image) >= size:
+            # already compact; re-encoding would only cost quality
+            blob_store.adopt(tmp, sha256)
+            return stored
+        if settings.proof_keep_originals:
+            blob_store.adopt(tmp, sha256)
+            stored["original_sha256"] = sha256
+        stored.update(blob_sha256=await blob_store.put(image), file_size=len(image), mime_type="image/jpeg")
+        return stored
+    finally:
+        tmp.unlink(missing_ok=True)
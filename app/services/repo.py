@@ -6,61 +6,98 @@ from typing import Any
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
-
-async def upsert_user(session: AsyncSession, tg_user_id: int, chat_id: int, username: str | None, referrer_id: int | None = None) -> dict[str, Any]:
-    q = text(
-        """
-        insert into tg_users (tg_user_id, chat_id, username, role, last_seen_at)
-        values (:tg_user_id, :chat_id, :username, 'user', now())
+from ..config import settings as app_settings
+from .catalog import catalog_cache
+from .last_seen import last_seen
+from .log_queue import log_queue
+from .session_store import DURABLE_STATES, clear_payload, merge_payload, session_store, writes_buffered, writes_through
+from .settings_cache import settings_cache
+from .user_context import get_user_context
+
+_MISSING = object()
+
+
+# only rewrites the row when something changed; last_seen_at goes through the buffer
+_UPSERT_USER = """
+    upserted as (
+        insert into tg_users (tg_user_id, chat_id, username, role, last_seen_at, referrer_id)
+        values (:tg_user_id, :chat_id, :username, 'user', now(), :referrer_id)
         on conflict (tg_user_id) do update
         set chat_id = excluded.chat_id,
             username = excluded.username,
-            last_seen_at = now()
-        returning id as user_id, tg_user_id, chat_id, username, role, is_blocked, referrer_id, referral_code;
-        """
+            referrer_id = coalesce(tg_users.referrer_id, nullif(excluded.referrer_id, tg_users.id))
+        where tg_users.chat_id is distinct from excluded.chat_id
+           or tg_users.username is distinct from excluded.username
+           or (tg_users.referrer_id is null and excluded.referrer_id is not null and excluded.referrer_id <> tg_users.id)
+        returning id as user_id, tg_user_id, chat_id, username, role, is_blocked, referrer_id, referral_code
+    ),
+    u as (
+        select * from upserted
+        union all
+        select id as user_id, tg_user_id, chat_id, username, role, is_blocked, referrer_id, referral_code
+        from tg_users
+        where tg_user_id = :tg_user_id and not exists (select 1 from upserted)
     )
-    res = await session.execute(q, {"tg_user_id": tg_user_id, "chat_id": chat_id, "username": username})
+"""
+
+
+async def _execute_upsert(session: AsyncSession, q, params: dict[str, Any]) -> dict[str, Any] | None:
+    res = await session.execute(q, params)
     row = res.mappings().first()
-    user = dict(row) if row else {}
-    if user:
-        if not user.get("referral_code"):
-            code = f"REF{user['user_id']}"
-            await session.execute(
-                text("update tg_users set referral_code = :code where id = :id"),
-                {"code": code, "id": user["user_id"]},
-            )
-            user["referral_code"] = code
-        if referrer_id and not user.get("referrer_id") and referrer_id != user.get("user_id"):
-            await session.execute(
-                text("update tg_users set referrer_id = :referrer_id where id = :id"),
-                {"referrer_id": referrer_id, "id": user["user_id"]},
-            )
-            user["referrer_id"] = referrer_id
-    return user
+    if row is None:
+        # inserted by a concurrent transaction after this statement's snapshot
+        res = await session.execute(q, params)
+        row = res.mappings().first()
+    return dict(row) if row else None
 
 
-async def ensure_session(session: AsyncSession, tg_user_id: int) -> dict[str, Any]:
+# upserts the user and creates the session in one round-trip, returning the load_user_with_session row
+async def bootstrap_user(session: AsyncSession, tg_user_id: int, chat_id: int, username: str | None, referrer_id: int | None = None) -> dict[str, Any]:
     q = text(
-        """
-        insert into tg_sessions (tg_user_id, state, payload, updated_at)
-        values (:tg_user_id, 'menu', '{}'::jsonb, now())
-        on conflict (tg_user_id) do update
-        set updated_at = now()
-        returning tg_user_id, state, payload;
+        "with " + _UPSERT_USER + """,
+        new_session as (
+            insert into tg_sessions (tg_user_id, state, payload, updated_at)
+            select tg_user_id, 'menu', '{}'::jsonb, now() from u
+            on conflict (tg_user_id) do nothing
+            returning state, payload, version
+        )
+        select u.*,
+               coalesce(ns.state, s.state) as state,
+               coalesce(ns.payload, s.payload) as payload,
+               coalesce(ns.version, s.version) as session_version
+        from u
+        left join new_session ns on true
+        left join tg_sessions s on s.tg_user_id = u.tg_user_id;
         """
     )
-    res = await session.execute(q, {"tg_user_id": tg_user_id})
-    row = res.mappings().first()
-    return dict(row) if row else {}
+    user = await _execute_upsert(session, q, {
+        "tg_user_id": tg_user_id,
+        "chat_id": chat_id,
+        "username": username,
+        "referrer_id": referrer_id,
+    }) or {}
+    if not user:
+        return user
+    last_seen.touch(tg_user_id)
+    _overlay_session(session, tg_user_id, user)
+    ctx = get_user_context(session)
+    if ctx:
+        ctx.put(tg_user_id, user)
+    return user
 
 
 async def load_user_with_session(session: AsyncSession, tg_user_id: int) -> dict[str, Any] | None:
+    ctx = get_user_context(session)
+    if ctx:
+        cached = ctx.get(tg_user_id, _MISSING)
+        if cached is not _MISSING:
+            return cached
     q = text(
         """
         select
           u.id as user_id, u.tg_user_id, u.chat_id, u.username, u.role, u.is_blocked,
           u.referrer_id, u.referral_code,
-          s.state, s.payload
+          s.state, s.payload, s.version as session_version
         from tg_users u
         left join tg_sessions s on s.tg_user_id = u.tg_user_id
         where u.tg_user_id = :tg_user_id
@@ -69,7 +106,15 @@ async def load_user_with_session(session: AsyncSession, tg_user_id: int) -> dict
     )
     res = await session.execute(q, {"tg_user_id": tg_user_id})
     row = res.mappings().first()
-    return dict(row) if row else None
+    user = dict(row) if row else None
+    if user:
+        if user.get("state") is not None:
+            _overlay_session(session, tg_user_id, user)
+        else:
+            user.pop("session_version", None)
+    if ctx:
+        ctx.put(tg_user_id, user)
+    return user
 
 
 async def load_user_by_id(session: AsyncSession, user_id: int) -> dict[str, Any] | None:
@@ -87,7 +132,10 @@ async def load_user_by_id(session: AsyncSession, user_id: int) -> dict[str, Any]
     return dict(row) if row else None
 
 
-async def _load_setting(session: AsyncSession, key: str, default: Any) -> Any:
+async def _read_setting(session: AsyncSession, key: str) -> Any:
+    value = settings_cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
     q = text(
         """
         select value_json
@@ -98,13 +146,21 @@ async def _load_setting(session: AsyncSession, key: str, default: Any) -> Any:
     )
     res = await session.execute(q, {"key": key})
     row = res.mappings().first()
-    if not row:
+    value = row["value_json"] if row else None
+    settings_cache.put(key, value)
+    return value
+
+
+async def _load_setting(session: AsyncSession, key: str, default: Any) -> Any:
+    value = await _read_setting(session, key)
+    if value is None:
         await session.execute(
-            text("insert into bot_settings (key, value_json, updated_at) values (:key, CAST(:value AS jsonb), now())"),
+            text("insert into bot_settings (key, value_json, updated_at) values (:key, CAST(:value AS jsonb), now()) on conflict (key) do nothing"),
             {"key": key, "value": json.dumps(default)},
         )
+        settings_cache.put(key, default)
         return default
-    return row["value_json"]
+    return value
 
 
 async def _save_setting(session: AsyncSession, key: str, value: Any) -> None:
@@ -118,6 +174,7 @@ async def _save_setting(session: AsyncSession, key: str, value: Any) -> None:
         ),
         {"key": key, "value": json.dumps(value)},
     )
+    settings_cache.invalidate(key)
 
 
 DEFAULT_REFERRAL_SETTINGS = {
@@ -125,96 +182,6 @@ DEFAULT_REFERRAL_SETTINGS = {
     "delay_hours": 24,
 }
 
-async def _ensure_support_schema(session: AsyncSession) -> None:
-    await session.execute(text("""
-        create table if not exists support_tickets (
-            id bigserial primary key,
-            user_id bigint not null references tg_users(id) on delete cascade,
-            tg_user_id bigint not null,
-            chat_id bigint not null,
-            username text,
-            status text not null default 'open',
-            user_ticket_id integer not null,
-            created_at timestamptz not null default now(),
-            updated_at timestamptz not null default now(),
-            message_count integer not null default 0
-        );
-    """))
-    await session.execute(text("""
-        create unique index if not exists ux_support_tickets_user_id_user_ticket_id
-        on support_tickets(user_id, user_ticket_id);
-    """))
-    await session.execute(text("""
-        create table if not exists support_messages (
-            id bigserial primary key,
-            ticket_id bigint not null references support_tickets(id) on delete cascade,
-            sender text not null,
-            text text not null,
-            created_at timestamptz not null default now()
-        );
-    """))
-
-
-async def _ensure_promo_schema(session: AsyncSession) -> None:
-    await session.execute(text("""
-        create table if not exists promo_codes (
-            code text primary key,
-            bonus integer not null,
-            active boolean not null default true,
-            max_uses integer,
-            used_count integer not null default 0,
-            expires_at timestamptz,
-            created_at timestamptz not null default now(),
-            updated_at timestamptz not null default now()
-        );
-    """))
-    await session.execute(text("""
-        create table if not exists promo_usages (
-            id bigserial primary key,
-            user_id bigint not null references tg_users(id) on delete cascade,
-            code text not null references promo_codes(code) on delete cascade,
-            used_at timestamptz not null default now(),
-            unique(user_id, code)
-        );
-    """))
-
-
-async def _ensure_referral_schema(session: AsyncSession) -> None:
-    await session.execute(text("""
-        create table if not exists referral_wallets (
-            user_id bigint primary key references tg_users(id) on delete cascade,
-            balance integer not null default 0,
-            updated_at timestamptz not null default now()
-        );
-    """))
-    await session.execute(text("""
-        create table if not exists referral_pending (
-            id bigserial primary key,
-            order_id bigint not null,
-            referrer_user_id bigint not null,
-            referred_user_id bigint not null,
-            amount_minor integer not null,
-            bonus_minor integer not null,
-            percent integer not null,
-            due_at timestamptz not null,
-            created_at timestamptz not null default now()
-        );
-    """))
-    await session.execute(text("""
-        create unique index if not exists ux_referral_pending_order_id
-        on referral_pending(order_id);
-    """))
-    await session.execute(text("""
-        create table if not exists referral_withdrawals (
-            id bigserial primary key,
-            user_id bigint not null references tg_users(id) on delete cascade,
-            amount integer not null,
-            status text not null default 'pending',
-            meta jsonb,
-            created_at timestamptz not null default now(),
-            updated_at timestamptz not null default now()
-        );
-    """))
 DEFAULT_SUPPORT_SETTINGS = {
     "admin_group_id": -5130507662,
 }
@@ -275,7 +242,6 @@ async def resolve_referrer_user_id(session: AsyncSession, referrer_id: int) -> i
 
 
 async def get_referral_pending(session: AsyncSession) -> list[dict[str, Any]]:
-    await _ensure_referral_schema(session)
     res = await session.execute(text("""
         select id, order_id, referrer_user_id, referred_user_id, amount_minor, bonus_minor, percent, due_at
         from referral_pending
@@ -285,7 +251,6 @@ async def get_referral_pending(session: AsyncSession) -> list[dict[str, Any]]:
 
 
 async def get_ref_withdrawals(session: AsyncSession) -> list[dict[str, Any]]:
-    await _ensure_referral_schema(session)
     res = await session.execute(text("""
         select id, user_id, amount, status, meta, created_at, updated_at
         from referral_withdrawals
@@ -295,7 +260,6 @@ async def get_ref_withdrawals(session: AsyncSession) -> list[dict[str, Any]]:
 
 
 async def add_ref_withdraw_request(session: AsyncSession, user_id: int, amount: int) -> str | None:
-    await _ensure_referral_schema(session)
     # one pending per user
     res = await session.execute(text("""
         select id from referral_withdrawals
@@ -314,7 +278,6 @@ async def add_ref_withdraw_request(session: AsyncSession, user_id: int, amount:
 
 
 async def get_ref_withdraw_request(session: AsyncSession, req_id: str) -> dict[str, Any] | None:
-    await _ensure_referral_schema(session)
     raw = str(req_id or "")
     if raw.upper().startswith("RW"):
         raw = raw[2:]
@@ -333,7 +296,6 @@ async def get_ref_withdraw_request(session: AsyncSession, req_id: str) -> dict[s
 
 
 async def update_ref_withdraw_status(session: AsyncSession, req_id: str, status: str, meta: dict | None = None) -> None:
-    await _ensure_referral_schema(session)
     raw = str(req_id or "")
     if raw.upper().startswith("RW"):
         raw = raw[2:]
@@ -354,19 +316,7 @@ async def update_ref_withdraw_status(session: AsyncSession, req_id: str, status:
     })
 
 
-async def _next_user_ticket_id(session: AsyncSession, user_id: int) -> int:
-    await _ensure_support_schema(session)
-    res = await session.execute(text("""
-        select coalesce(max(user_ticket_id), 0) + 1 as next_id
-        from support_tickets
-        where user_id = :user_id;
-    """), {"user_id": user_id})
-    row = res.mappings().first()
-    return int(row["next_id"]) if row else 1
-
-
 async def get_support_tickets(session: AsyncSession) -> list[dict[str, Any]]:
-    await _ensure_support_schema(session)
     res = await session.execute(text("""
         select id, user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count
         from support_tickets
@@ -376,7 +326,6 @@ async def get_support_tickets(session: AsyncSession) -> list[dict[str, Any]]:
 
 
 async def _save_support_tickets(session: AsyncSession, tickets: list[dict[str, Any]]) -> None:
-    await _ensure_support_schema(session)
     for t in tickets:
         await session.execute(text("""
             insert into support_tickets
@@ -402,7 +351,6 @@ async def _save_support_tickets(session: AsyncSession, tickets: list[dict[str, A
 
 
 async def get_support_messages(session: AsyncSession) -> list[dict[str, Any]]:
-    await _ensure_support_schema(session)
     res = await session.execute(text("""
         select id, ticket_id, sender, text, created_at
         from support_messages
@@ -412,7 +360,6 @@ async def get_support_messages(session: AsyncSession) -> list[dict[str, Any]]:
 
 
 async def _save_support_messages(session: AsyncSession, messages: list[dict[str, Any]]) -> None:
-    await _ensure_support_schema(session)
     for m in messages:
         await session.execute(text("""
             insert into support_messages (id, ticket_id, sender, text, created_at)
@@ -428,7 +375,6 @@ async def _save_support_messages(session: AsyncSession, messages: list[dict[str,
 
 
 async def list_support_tickets_for_user(session: AsyncSession, user_id: int) -> list[dict[str, Any]]:
-    await _ensure_support_schema(session)
     res = await session.execute(text("""
         select id, user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count
         from support_tickets
@@ -439,7 +385,6 @@ async def list_support_tickets_for_user(session: AsyncSession, user_id: int) ->
 
 
 async def get_support_ticket(session: AsyncSession, ticket_id: int) -> dict[str, Any] | None:
-    await _ensure_support_schema(session)
     res = await session.execute(text("""
         select id, user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count
         from support_tickets
@@ -451,7 +396,6 @@ async def get_support_ticket(session: AsyncSession, ticket_id: int) -> dict[str,
 
 
 async def count_open_tickets_for_user(session: AsyncSession, user_id: int) -> int:
-    await _ensure_support_schema(session)
     res = await session.execute(text("""
         select count(*) as cnt
         from support_tickets
@@ -462,7 +406,6 @@ async def count_open_tickets_for_user(session: AsyncSession, user_id: int) -> in
 
 
 async def get_last_open_ticket_for_user(session: AsyncSession, user_id: int) -> dict[str, Any] | None:
-    await _ensure_support_schema(session)
     res = await session.execute(text("""
         select id, user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count
         from support_tickets
@@ -475,28 +418,31 @@ async def get_last_open_ticket_for_user(session: AsyncSession, user_id: int) ->
 
 
 async def add_support_ticket(session: AsyncSession, user: dict, message_text: str) -> dict[str, Any]:
-    await _ensure_support_schema(session)
-    user_ticket_id = await _next_user_ticket_id(session, int(user["user_id"]))
     res = await session.execute(text("""
-        insert into support_tickets
-          (user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count)
-        values
-          (:user_id, :tg_user_id, :chat_id, :username, 'open', :user_ticket_id, now(), now(), 0)
-        returning id, user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count;
+        with t as (
+            insert into support_tickets
+              (user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count)
+            select
+              :user_id, :tg_user_id, :chat_id, :username, 'open', coalesce(max(user_ticket_id), 0) + 1, now(), now(), 1
+            from support_tickets
+            where user_id = :user_id
+            returning id, user_id, tg_user_id, chat_id, username, status, user_ticket_id, created_at, updated_at, message_count
+        ), m as (
+            insert into support_messages (ticket_id, sender, text, created_at)
+            select id, 'user', :text, now() from t
+        )
+        select * from t;
     """), {
         "user_id": int(user["user_id"]),
         "tg_user_id": int(user["tg_user_id"]),
         "chat_id": int(user["chat_id"]),
         "username": user.get("username"),
-        "user_ticket_id": user_ticket_id,
+        "text": message_text,
     })
-    ticket = dict(res.mappings().first())
-    await add_support_message(session, ticket["id"], "user", message_text)
-    return ticket
+    return dict(res.mappings().first())
 
 
 async def add_support_message(session: AsyncSession, ticket_id: int, sender: str, text: str) -> None:
-    await _ensure_support_schema(session)
     await session.execute(text("""
         insert into support_messages (ticket_id, sender, text, created_at)
         values (:ticket_id, :sender, :text, now());
@@ -510,7 +456,6 @@ async def add_support_message(session: AsyncSession, ticket_id: int, sender: str
 
 
 async def list_support_messages_for_ticket(session: AsyncSession, ticket_id: int, limit: int = 10) -> list[dict[str, Any]]:
-    await _ensure_support_schema(session)
     res = await session.execute(text("""
         select id, ticket_id, sender, text, created_at
         from support_messages
@@ -522,7 +467,6 @@ async def list_support_messages_for_ticket(session: AsyncSession, ticket_id: int
 
 
 async def close_support_ticket(session: AsyncSession, ticket_id: int) -> None:
-    await _ensure_support_schema(session)
     await session.execute(text("""
         update support_tickets
         set status = 'closed', updated_at = now()
@@ -544,7 +488,6 @@ async def count_referrals(session: AsyncSession, referrer_user_id: int) -> int:
 
 
 async def get_referral_wallet(session: AsyncSession, referrer_user_id: int) -> int:
-    await _ensure_referral_schema(session)
     res = await session.execute(text("""
         insert into referral_wallets (user_id, balance, updated_at)
         values (:user_id, 0, now())
@@ -556,7 +499,6 @@ async def get_referral_wallet(session: AsyncSession, referrer_user_id: int) -> i
 
 
 async def add_referral_wallet(session: AsyncSession, referrer_user_id: int, amount: int) -> int:
-    await _ensure_referral_schema(session)
     res = await session.execute(text("""
         insert into referral_wallets (user_id, balance, updated_at)
         values (:user_id, :amount, now())
@@ -570,7 +512,6 @@ async def add_referral_wallet(session: AsyncSession, referrer_user_id: int, amou
 
 
 async def clear_referral_wallet(session: AsyncSession, referrer_user_id: int) -> None:
-    await _ensure_referral_schema(session)
     await session.execute(text("""
         update referral_wallets
         set balance = 0, updated_at = now()
@@ -585,7 +526,6 @@ async def add_referral_pending(
     amount_minor: int,
     order_id: int,
 ) -> int:
-    await _ensure_referral_schema(session)
     settings = await get_referral_settings(session)
     percent = int(settings.get("percent") or 0)
     if percent <= 0:
@@ -630,160 +570,287 @@ async def has_referral_bonus(session: AsyncSession, order_id: int) -> bool:
     return bool(row)
 
 
-async def process_referral_pending(session: AsyncSession, referrer_user_id: int) -> int:
-    await _ensure_referral_schema(session)
-    canonical_ref_id = await resolve_referrer_user_id(session, referrer_user_id)
-    if not canonical_ref_id:
-        canonical_ref_id = referrer_user_id
+async def settle_referral_batch(
+    session: AsyncSession,
+    limit: int = 500,
+    after_id: int = 0,
+) -> tuple[int, int, int]:
+    # SKIP LOCKED lets settlers on several replicas take disjoint chunks.
+    # Unresolvable referrers stay pending; feed last_id back as after_id to move past them.
     res = await session.execute(text("""
-        select id, order_id, referrer_user_id, bonus_minor, due_at
-        from referral_pending
-        where due_at <= now();
-    """))
-    rows = [dict(r) for r in res.mappings().all()]
-    applied = 0
-    for item in rows:
-        item_ref_id = int(item.get("referrer_user_id") or 0)
-        if item_ref_id != canonical_ref_id:
-            resolved = await resolve_referrer_user_id(session, item_ref_id)
-            if resolved != canonical_ref_id:
-                continue
-        bonus = int(item.get("bonus_minor") or 0)
-        if bonus <= 0:
-            continue
-        await add_referral_wallet(session, canonical_ref_id, bonus)
-        await session.execute(text("delete from referral_pending where id = :id"), {"id": item["id"]})
-        applied += 1
-    return applied
-
-
-async def process_referral_pending_all(session: AsyncSession) -> int:
-    await _ensure_referral_schema(session)
+        with due as (
+            select id, referrer_user_id, bonus_minor
+            from referral_pending
+            where due_at <= now()
+              and bonus_minor > 0
+              and id > :after_id
+            order by id
+            limit :limit
+            for update skip locked
+        ), resolved as (
+            select d.id, d.bonus_minor,
+                   coalesce(
+                       (select u.id from tg_users u where u.id = d.referrer_user_id),
+                       (select u.id from tg_users u where u.tg_user_id = d.referrer_user_id)
+                   ) as ref_user_id
+            from due d
+        ), settled as (
+            select id, bonus_minor, ref_user_id
+            from resolved
+            where ref_user_id is not null
+        ), credited as (
+            insert into referral_wallets (user_id, balance, updated_at)
+            select ref_user_id, sum(bonus_minor), now()
+            from settled
+            group by ref_user_id
+            order by ref_user_id
+            on conflict (user_id) do update
+            set balance = referral_wallets.balance + excluded.balance,
+                updated_at = now()
+        ), deleted as (
+            delete from referral_pending p
+            using settled s
+            where p.id = s.id
+            returning p.id
+        )
+        select (select count(*) from due) as claimed,
+               (select count(*) from deleted) as settled,
+               coalesce((select max(id) from due), :after_id) as last_id;
+    """), {"limit": int(limit), "after_id": int(after_id)})
+    row = res.mappings().first()
+    return int(row["claimed"]), int(row["settled"]), int(row["last_id"])
+
+
+async def write_sessions(session: AsyncSession, rows: list[dict[str, Any]]) -> dict[int, int]:
+    # only rows still at the version they were buffered from, and never over a
+    # payment proof state: those are written through and always win
+    if not rows:
+        return {}
     res = await session.execute(text("""
-        select id, order_id, referrer_user_id, bonus_minor, due_at
-        from referral_pending
-        where due_at <= now();
-    """))
-    rows = [dict(r) for r in res.mappings().all()]
-    applied = 0
-    for item in rows:
-        bonus = int(item.get("bonus_minor") or 0)
-        if bonus <= 0:
-            continue
-        item_ref_id = int(item.get("referrer_user_id") or 0)
-        ref_user_id = await resolve_referrer_user_id(session, item_ref_id)
-        if not ref_user_id:
-            continue
-        await add_referral_wallet(session, ref_user_id, bonus)
-        await session.execute(text("delete from referral_pending where id = :id"), {"id": item["id"]})
-        applied += 1
-    return applied
+        update tg_sessions s
+        set state = v.state,
+            payload = v.payload,
+            updated_at = now()
+        from jsonb_to_recordset(CAST(:rows AS jsonb)) as v(tg_user_id bigint, state text, payload jsonb, version bigint)
+        where s.tg_user_id = v.tg_user_id
+          and s.version = v.version
+          and s.state <> all(CAST(:durable AS text[]))
+        returning s.tg_user_id, s.version;
+    """), {"rows": json.dumps(rows), "durable": sorted(DURABLE_STATES)})
+    return {int(r[0]): int(r[1]) for r in res.all()}
+
+
+async def write_last_seen(session: AsyncSession, pending: dict[int, datetime]) -> int:
+    if not pending:
+        return 0
+    rows = [{"tg_user_id": k, "seen_at": v.isoformat()} for k, v in pending.items()]
+    res = await session.execute(text("""
+        update tg_users u
+        set last_seen_at = v.seen_at
+        from jsonb_to_recordset(CAST(:rows AS jsonb)) as v(tg_user_id bigint, seen_at timestamptz)
+        where u.tg_user_id = v.tg_user_id
+          and (u.last_seen_at is null or u.last_seen_at < v.seen_at);
+    """), {"rows": json.dumps(rows)})
+    return res.rowcount or 0
+
+
+def _current_session(session: AsyncSession, tg_user_id: int) -> tuple[str, dict, int | None] | None:
+    # this transaction's staged write first, then the write-back store
+    staged = session.info.get("staged_sessions") or {}
+    if tg_user_id in staged:
+        return staged[tg_user_id][:3]
+    return session_store.get(tg_user_id)
+
+
+def _overlay_session(session: AsyncSession, tg_user_id: int, user: dict[str, Any]) -> None:
+    version = user.pop("session_version", None)
+    if not app_settings.session_write_back:
+        return
+    staged = session.info.get("staged_sessions") or {}
+    if tg_user_id in staged:
+        user["state"], user["payload"] = staged[tg_user_id][:2]
+    elif session_store.is_dirty(tg_user_id):
+        user["state"], user["payload"], _ = session_store.get(tg_user_id)
+    else:
+        session_store.remember(tg_user_id, user["state"], user.get("payload"), version)
+
+
+async def _stage_session(session: AsyncSession, tg_user_id: int, prev_state: str, state: str, payload: dict, version: int | None) -> None:
+    # session_store only learns about the write once the transaction commits
+    if prev_state in DURABLE_STATES or state in DURABLE_STATES:
+        res = await session.execute(text("""
+            update tg_sessions
+            set state = :state, payload = CAST(:payload AS jsonb), updated_at = now()
+            where tg_user_id = :tg_user_id
+            returning version;
+        """), {"tg_user_id": tg_user_id, "state": state, "payload": json.dumps(payload)})
+        version = res.scalar_one_or_none()
+        dirty = False
+        # until commit the row is the only truth; a flush racing us now loses on version
+        session_store.forget(tg_user_id)
+        writes_through.inc()
+    else:
+        dirty = True
+        writes_buffered.inc()
+
+    after_commit = getattr(session, "after_commit", None)
+    if after_commit is None:
+        session_store.update(tg_user_id, state, payload, version, dirty=dirty)
+        return
+    staged = session.info.get("staged_sessions")
+    if staged is None:
+        staged = session.info["staged_sessions"] = {}
+
+        async def apply():
+            for staged_id, (staged_state, staged_payload, staged_version, staged_dirty) in session.info.pop("staged_sessions", {}).items():
+                session_store.update(staged_id, staged_state, staged_payload, staged_version, dirty=staged_dirty)
+
+        after_commit(apply)
+    staged[tg_user_id] = (state, payload, version, dirty)
 
 
 async def set_state_clear(session: AsyncSession, tg_user_id: int, state: str) -> None:
-    q = text(
-        """
-        update tg_sessions
-        set state = :state,
-            payload = payload - 'buy' - 'connect',
-            updated_at = now()
-        where tg_user_id = :tg_user_id;
-        """
-    )
-    await session.execute(q, {"tg_user_id": tg_user_id, "state": state})
+    current = _current_session(session, tg_user_id) if app_settings.session_write_back else None
+    if current is not None:
+        await _stage_session(session, tg_user_id, current[0], state, clear_payload(current[1]), current[2])
+    else:
+        q = text(
+            """
+            update tg_sessions
+            set state = :state,
+                payload = payload - 'buy' - 'connect',
+                updated_at = now()
+            where tg_user_id = :tg_user_id;
+            """
+        )
+        await session.execute(q, {"tg_user_id": tg_user_id, "state": state})
+    ctx = get_user_context(session)
+    if ctx:
+        ctx.apply_state_clear(tg_user_id, state)
 
 
 async def set_state_payload(session: AsyncSession, tg_user_id: int, state: str, key: str, value: Any) -> None:
-    q = text(
-        """
-        update tg_sessions
-        set payload =
-              coalesce(payload, '{}'::jsonb)
-              || jsonb_build_object(
-                   CAST(:key AS text),
-                   coalesce(payload->CAST(:key AS text), '{}'::jsonb)
-                   || CAST(:value AS jsonb)
-                 ),
-            state = :state,
-            updated_at = now()
-        where tg_user_id = :tg_user_id;
-        """
+    current = _current_session(session, tg_user_id) if app_settings.session_write_back else None
+    if current is not None:
+        await _stage_session(session, tg_user_id, current[0], state, merge_payload(current[1], key, value), current[2])
+    else:
+        q = text(
+            """
+            update tg_sessions
+            set payload =
+                  coalesce(payload, '{}'::jsonb)
+                  || jsonb_build_object(
+                       CAST(:key AS text),
+                       coalesce(payload->CAST(:key AS text), '{}'::jsonb)
+                       || CAST(:value AS jsonb)
+                     ),
+                state = :state,
+                updated_at = now()
+            where tg_user_id = :tg_user_id;
+            """
+        )
+        await session.execute(q, {
+            "tg_user_id": tg_user_id,
+            "state": state,
+            "key": key,
+            "value": json.dumps(value),
+        })
+    ctx = get_user_context(session)
+    if ctx:
+        ctx.apply_state_payload(tg_user_id, state, key, value)
+
+
+async def _catalog_plans(session: AsyncSession) -> None:
+    res = await session.execute(
+        text("select id, code, title, duration_days, price_minor, currency, enabled from plans")
     )
-    await session.execute(q, {
-        "tg_user_id": tg_user_id,
-        "state": state,
-        "key": key,
-        "value": json.dumps(value),
-    })
+    catalog_cache.put_plans([dict(r) for r in res.mappings().all()])
 
 
 async def list_servers(session: AsyncSession) -> list[dict[str, Any]]:
+    servers = catalog_cache.servers()
+    if servers is None:
+        res = await session.execute(
+            text(
+                """
+                select id, name, country, capacity
+                from vpn_servers
+                where enabled = true
+                order by weight desc, id asc;
+                """
+            )
+        )
+        catalog_cache.put_servers([dict(r) for r in res.mappings().all()])
+        servers = catalog_cache.servers() or []
+    if not servers:
+        return []
+    res = await session.execute(
+        text("select server_id, active_keys as cnt from server_load where server_id = any(:ids)"),
+        {"ids": [s["id"] for s in servers]},
+    )
+    counts = {r["server_id"]: r["cnt"] for r in res.mappings().all()}
+    for server in servers:
+        server["active_keys"] = counts.get(server["id"], 0)
+    return servers
+
+
+async def reconcile_server_load(session: AsyncSession) -> int:
+    # blocks the vpn_profiles trigger until commit so the recount can't race an increment
+    await session.execute(text("lock table server_load in exclusive mode"))
     q = text(
         """
-        select s.id, s.name, s.country,
-               s.capacity,
-               coalesce(p.cnt, 0) as active_keys
-        from vpn_servers s
-        left join (
-            select server_id, count(*) as cnt
+        with actual as (
+            select server_id, count(*)::int as cnt
             from vpn_profiles
-            where status = 'active' and revoked_at is null
+            where status = 'active' and revoked_at is null and server_id is not null
             group by server_id
-        ) p on p.server_id = s.id
-        where s.enabled = true
-        order by s.weight desc, s.id asc;
+        ),
+        fixed as (
+            insert into server_load (server_id, active_keys)
+            select server_id, cnt from actual
+            on conflict (server_id) do update
+            set active_keys = excluded.active_keys, updated_at = now()
+            where server_load.active_keys <> excluded.active_keys
+            returning server_id
+        ),
+        zeroed as (
+            update server_load l
+            set active_keys = 0, updated_at = now()
+            where l.active_keys <> 0
+              and not exists (select 1 from actual a where a.server_id = l.server_id)
+            returning l.server_id
+        )
+        select (select count(*) from fixed) + (select count(*) from zeroed) as drift;
         """
     )
     res = await session.execute(q)
-    return [dict(r) for r in res.mappings().all()]
+    return int(res.scalar() or 0)
 
 
 async def list_plans(session: AsyncSession) -> list[dict[str, Any]]:
-    q = text(
-        """
-        select id, code, title, duration_days, price_minor, currency
-        from plans
-        where enabled = true
-        order by price_minor asc, id asc;
-        """
-    )
-    res = await session.execute(q)
-    return [dict(r) for r in res.mappings().all()]
+    plans = catalog_cache.plans()
+    if plans is None:
+        await _catalog_plans(session)
+        plans = catalog_cache.plans() or []
+    return plans
 
 
 async def load_plan(session: AsyncSession, plan_id: int) -> dict[str, Any] | None:
-    q = text(
-        """
-        select id, code, title, duration_days, price_minor, currency
-        from plans
-        where id = :id
-        limit 1;
-        """
-    )
-    res = await session.execute(q, {"id": plan_id})
-    row = res.mappings().first()
-    return dict(row) if row else None
+    if plan_id is None:
+        return None
+    plan = catalog_cache.plan(int(plan_id), _MISSING)
+    if plan is _MISSING:
+        await _catalog_plans(session)
+        plan = catalog_cache.plan(int(plan_id))
+    return plan
 
 
 async def load_admin_ids(session: AsyncSession) -> list[int]:
-    q = text(
-        """
-        select value_json
-        from bot_settings
-        where key = 'ADMIN_TG_IDS'
-        limit 1;
-        """
-    )
-    res = await session.execute(q)
-    row = res.mappings().first()
-    if not row:
-        return []
-    ids = row["value_json"] or []
-    return [int(x) for x in ids]
+    ids = await _read_setting(session, "ADMIN_TG_IDS")
+    return [int(x) for x in ids or []]
 
 
 async def get_promo_codes(session: AsyncSession) -> list[dict[str, Any]]:
-    await _ensure_promo_schema(session)
     res = await session.execute(text("""
         select code, bonus, active, max_uses, used_count, expires_at
         from promo_codes
@@ -793,7 +860,6 @@ async def get_promo_codes(session: AsyncSession) -> list[dict[str, Any]]:
 
 
 async def _save_promo_codes(session: AsyncSession, codes: list[dict[str, Any]]) -> None:
-    await _ensure_promo_schema(session)
     for c in codes:
         await session.execute(text("""
             insert into promo_codes (code, bonus, active, max_uses, used_count, expires_at, updated_at)
@@ -816,7 +882,6 @@ async def _save_promo_codes(session: AsyncSession, codes: list[dict[str, Any]])
 
 
 async def _get_promo_used(session: AsyncSession, user_id: int) -> list[str]:
-    await _ensure_promo_schema(session)
     res = await session.execute(text("""
         select code from promo_usages where user_id = :user_id;
     """), {"user_id": user_id})
@@ -824,7 +889,6 @@ async def _get_promo_used(session: AsyncSession, user_id: int) -> list[str]:
 
 
 async def _save_promo_used(session: AsyncSession, user_id: int, used: list[str]) -> None:
-    await _ensure_promo_schema(session)
     for code in set([str(u).upper() for u in used]):
         await session.execute(text("""
             insert into promo_usages (user_id, code, used_at)
@@ -838,7 +902,6 @@ async def redeem_promo(session: AsyncSession, user_id: int, code_raw: str) -> tu
     if not code:
         return False, "Введите промокод.", 0
 
-    await _ensure_promo_schema(session)
     res = await session.execute(text("""
         select code, bonus, active, max_uses, used_count, expires_at
         from promo_codes
@@ -986,27 +1049,41 @@ async def insert_payment_order(session: AsyncSession, user_id: int, plan_id: int
     return int(row["id"])
 
 
-async def insert_payment_proof(session: AsyncSession, order_id: int, file_id: str, file_name: str | None, mime_type: str | None, file_size: int | None, file_data: bytes) -> None:
+async def insert_payment_proof(
+    session: AsyncSession,
+    order_id: int,
+    file_id: str,
+    file_name: str | None,
+    mime_type: str | None,
+    file_size: int | None,
+    blob_sha256: str,
+    thumb_sha256: str | None = None,
+    original_sha256: str | None = None,
+) -> int:
     q = text(
         """
-        insert into payment_proofs (order_id, tg_file_id, file_name, mime_type, file_size, file_data)
-        values (:order_id, :tg_file_id, :file_name, :mime_type, :file_size, :file_data);
+        insert into payment_proofs (order_id, tg_file_id, file_name, mime_type, file_size, blob_sha256, thumb_sha256, original_sha256)
+        values (:order_id, :tg_file_id, :file_name, :mime_type, :file_size, :blob_sha256, :thumb_sha256, :original_sha256)
+        returning id;
         """
     )
-    await session.execute(q, {
+    res = await session.execute(q, {
         "order_id": order_id,
         "tg_file_id": file_id,
         "file_name": file_name,
         "mime_type": mime_type,
         "file_size": file_size,
-        "file_data": file_data,
+        "blob_sha256": blob_sha256,
+        "thumb_sha256": thumb_sha256,
+        "original_sha256": original_sha256,
     })
+    return int(res.scalar_one())
 
 
 async def load_payment_proof(session: AsyncSession, order_id: int) -> dict[str, Any] | None:
     q = text(
         """
-        select id, tg_file_id, file_name, mime_type, file_size, created_at
+        select id, tg_file_id, file_name, mime_type, file_size, blob_sha256, thumb_sha256, original_sha256, created_at
         from payment_proofs
         where order_id = :order_id
         order by id desc
@@ -1018,33 +1095,238 @@ async def load_payment_proof(session: AsyncSession, order_id: int) -> dict[str,
     return dict(row) if row else None
 
 
+async def claim_inline_proofs(session: AsyncSession, limit: int) -> list[dict[str, Any]]:
+    res = await session.execute(text("""
+        select id, file_data
+        from payment_proofs
+        where blob_sha256 is null and file_data is not null
+        order by id
+        limit :limit
+        for update skip locked;
+    """), {"limit": limit})
+    return [dict(r) for r in res.mappings().all()]
+
+
+async def set_proof_blobs(session: AsyncSession, rows: list[dict[str, Any]]) -> None:
+    if not rows:
+        return
+    await session.execute(text("""
+        update payment_proofs p
+        set blob_sha256 = v.blob_sha256, file_data = null
+        from jsonb_to_recordset(CAST(:rows AS jsonb)) as v(id bigint, blob_sha256 text)
+        where p.id = v.id;
+    """), {"rows": json.dumps(rows)})
+
+
+async def insert_proof_fingerprints(session: AsyncSession, rows: list[dict[str, Any]]) -> None:
+    if not rows:
+        return
+    await session.execute(text("""
+        insert into payment_proof_fingerprints (proof_id, order_id, sha256, dhash, band0, band1, band2, band3)
+        select v.proof_id, v.order_id, v.sha256, v.dhash, v.band0, v.band1, v.band2, v.band3
+        from jsonb_to_recordset(CAST(:rows AS jsonb))
+          as v(proof_id bigint, order_id bigint, sha256 text, dhash bigint, band0 integer, band1 integer, band2 integer, band3 integer)
+        on conflict (proof_id) do nothing;
+    """), {"rows": json.dumps(rows)})
+
+
+async def find_proof_fingerprints(
+    session: AsyncSession,
+    sha256: str,
+    dhash: int | None,
+    bands: list[int] | None,
+    max_distance: int,
+    exclude_order_id: int,
+    limit: int = 200,
+) -> list[dict[str, Any]]:
+    # the bands only find candidates; the bit distance is computed here so the limit
+    # keeps the closest ones, not whichever orders are newest among lookalike screenshots
+    bands = bands or [None] * 4
+    res = await session.execute(text("""
+        select c.*
+        from (
+            select f.order_id, f.sha256, f.dhash, o.status, o.user_id, u.tg_user_id, u.username, o.created_at,
+                   coalesce(f.sha256 = :sha256, false) as exact,
+                   length(replace(CAST(CAST(f.dhash # CAST(:dhash AS bigint) AS bit(64)) AS text), '0', '')) as distance
+            from payment_proof_fingerprints f
+            join payment_orders o on o.id = f.order_id
+            join tg_users u on u.id = o.user_id
+            where f.order_id <> :exclude_order_id
+              and (f.sha256 = :sha256
+                   or f.band0 = CAST(:band0 AS integer)
+                   or f.band1 = CAST(:band1 AS integer)
+                   or f.band2 = CAST(:band2 AS integer)
+                   or f.band3 = CAST(:band3 AS integer))
+        ) c
+        where c.exact or c.distance <= :max_distance
+        order by c.exact desc, c.distance nulls last, c.order_id desc
+        limit :limit;
+    """), {
+        "sha256": sha256,
+        "dhash": dhash,
+        "band0": bands[0],
+        "band1": bands[1],
+        "band2": bands[2],
+        "band3": bands[3],
+        "max_distance": max_distance,
+        "exclude_order_id": exclude_order_id,
+        "limit": limit,
+    })
+    return [dict(r) for r in res.mappings().all()]
+
+
+async def claim_unfingerprinted_proofs(session: AsyncSession, limit: int) -> list[dict[str, Any]]:
+    res = await session.execute(text("""
+        select p.id, p.order_id, p.mime_type, p.blob_sha256, p.thumb_sha256, p.original_sha256
+        from payment_proofs p
+        where p.blob_sha256 is not null
+          and not exists (select 1 from payment_proof_fingerprints f where f.proof_id = p.id)
+        order by p.id
+        limit :limit
+        for update of p skip locked;
+    """), {"limit": limit})
+    return [dict(r) for r in res.mappings().all()]
+
+
 async def log_event(session: AsyncSession, category: str, level: str, tg_user_id: int | None, user_id: int | None, action: str, message: str | None, context: dict | None = None) -> None:
-    q = text(
-        """
-        insert into logs(category, level, tg_user_id, user_id, action, message, context)
-        values (:category, :level, :tg_user_id, :user_id, :action, :message, CAST(:context AS jsonb));
-        """
-    )
-    await session.execute(q, {
+    # queued for the batch writer; inside an update only once the business transaction commits
+    entry = {
         "category": category,
         "level": level,
         "tg_user_id": tg_user_id,
         "user_id": user_id,
         "action": action,
         "message": message,
-        "context": json.dumps(context or {}),
-    })
+        "context": context or {},
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    after_commit = getattr(session, "after_commit", None)
+    if after_commit is None:
+        log_queue.put(entry)
+        return
+
+    async def enqueue():
+        log_queue.put(entry)
 
+    after_commit(enqueue)
 
-async def update_order_status(session: AsyncSession, order_id: int, status: str) -> None:
+
+async def write_logs(session: AsyncSession, rows: list[dict[str, Any]]) -> None:
+    if not rows:
+        return
+    await session.execute(text("""
+        insert into logs (category, level, tg_user_id, user_id, action, message, context, created_at)
+        select category, level, tg_user_id, user_id, action, message, context, created_at
+        from jsonb_to_recordset(CAST(:rows AS jsonb)) as v(
+            category text, level text, tg_user_id bigint, user_id bigint,
+            action text, message text, context jsonb, created_at timestamptz
+        );
+    """), {"rows": json.dumps(rows, default=str)})
+
+
+async def transition_order(session: AsyncSession, order_id: int, from_status: str, to_status: str) -> bool:
+    # the status check and the write are one statement, so only one caller wins
+    res = await session.execute(text("""
+        update payment_orders
+        set status = :to_status, updated_at = now()
+        where id = :id and status = :from_status
+        returning id;
+    """), {"id": order_id, "from_status": from_status, "to_status": to_status})
+    return res.first() is not None
+
+
+async def load_orders_by_code(session: AsyncSession, codes: list[str]) -> list[dict[str, Any]]:
     q = text(
         """
-        update payment_orders
-        set status = :status, updated_at = now()
-        where id = :id;
+        select o.id, o.user_id, o.plan_id, o.amount_minor, o.currency, o.status, o.meta,
+               u.chat_id, u.username, u.tg_user_id
+        from payment_orders o
+        join tg_users u on u.id = o.user_id
+        where o.meta->>'code' = any(:codes)
+        order by o.id;
         """
     )
-    await session.execute(q, {"id": order_id, "status": status})
+    res = await session.execute(q, {"codes": codes})
+    return [dict(r) for r in res.mappings().all()]
+
+
+async def insert_moderation_item(session: AsyncSession, order_id: int, caption: str) -> None:
+    await session.execute(text("""
+        insert into moderation_items (order_id, caption)
+        values (:order_id, :caption)
+        on conflict (order_id) do nothing;
+    """), {"order_id": order_id, "caption": caption})
+
+
+async def claim_moderation_item(session: AsyncSession, order_id: int, admin_id: int, ttl: int) -> bool:
+    # skip locked: a concurrent claim gets nothing instead of waiting for the other admin
+    res = await session.execute(text("""
+        update moderation_items m
+        set status = 'claimed', claimed_by = :admin_id, claimed_at = now()
+        where m.id = (
+            select id
+            from moderation_items
+            where order_id = :order_id
+              and status <> 'done'
+              and (status = 'open' or claimed_by = :admin_id or claimed_at < now() - CAST(:ttl AS integer) * interval '1 second')
+            for update skip locked
+        )
+        returning m.id;
+    """), {"order_id": order_id, "admin_id": admin_id, "ttl": ttl})
+    return res.first() is not None
+
+
+async def claim_next_moderation_item(session: AsyncSession, admin_id: int, ttl: int) -> dict[str, Any] | None:
+    res = await session.execute(text("""
+        update moderation_items m
+        set status = 'claimed', claimed_by = :admin_id, claimed_at = now()
+        where m.id = (
+            select id
+            from moderation_items
+            where status = 'open' or (status = 'claimed' and claimed_at < now() - CAST(:ttl AS integer) * interval '1 second')
+            order by id
+            limit 1
+            for update skip locked
+        )
+        returning m.order_id, m.caption;
+    """), {"admin_id": admin_id, "ttl": ttl})
+    row = res.mappings().first()
+    return dict(row) if row else None
+
+
+async def load_moderation_item(session: AsyncSession, order_id: int) -> dict[str, Any] | None:
+    res = await session.execute(text("""
+        select id, order_id, status, caption, claimed_by, claimed_at, messages, resolution
+        from moderation_items
+        where order_id = :order_id;
+    """), {"order_id": order_id})
+    row = res.mappings().first()
+    return dict(row) if row else None
+
+
+async def add_moderation_messages(session: AsyncSession, order_id: int, messages: dict[str, int]) -> str | None:
+    # appended per chat: an admin who pulls an item they already got keeps both copies on record
+    res = await session.execute(text("""
+        update moderation_items m
+        set messages = m.messages || (
+            select coalesce(jsonb_object_agg(n.key, coalesce(m.messages -> n.key, '[]'::jsonb) || jsonb_build_array(n.value)), '{}'::jsonb)
+            from jsonb_each(CAST(:messages AS jsonb)) n
+        )
+        where m.order_id = :order_id
+        returning m.status;
+    """), {"order_id": order_id, "messages": json.dumps(messages)})
+    return res.scalar_one_or_none()
+
+
+async def finish_moderation_item(session: AsyncSession, order_id: int, resolution: str) -> dict[str, list[int]] | None:
+    res = await session.execute(text("""
+        update moderation_items
+        set status = 'done', resolution = :resolution, resolved_at = now()
+        where order_id = :order_id and status <> 'done'
+        returning messages;
+    """), {"order_id": order_id, "resolution": resolution})
+    row = res.first()
+    return row[0] if row else None
 
 
 async def load_order(session: AsyncSession, order_id: int) -> dict[str, Any] | None:
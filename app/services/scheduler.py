@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from sqlalchemy import text
+
+from ..db import engine
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    name: str
+    func: Callable[[], Awaitable[None]]
+    interval: float
+    jitter: float = 0.0
+    # leader jobs run on one replica at a time, guarded by a Postgres advisory lock
+    leader: bool = False
+    # run once more on shutdown, for flushers of in-memory buffers
+    run_on_stop: bool = False
+
+    @property
+    def lock_key(self) -> int:
+        return zlib.crc32(f"scheduler:{self.name}".encode("utf-8"))
+
+
+class Scheduler:
+    def __init__(self) -> None:
+        self._jobs: list[Job] = []
+        self._tasks: list[asyncio.Task] = []
+
+    def add_job(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[None]],
+        interval: float,
+        jitter: float = 0.0,
+        leader: bool = False,
+        run_on_stop: bool = False,
+    ) -> None:
+        self._jobs.append(Job(name, func, interval, jitter, leader, run_on_stop))
+
+    async def start(self) -> None:
+        for job in self._jobs:
+            self._tasks.append(asyncio.create_task(self._loop(job), name=f"job:{job.name}"))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for job in self._jobs:
+            if job.run_on_stop:
+                try:
+                    await self.run_once(job)
+                except Exception:
+                    logger.exception("final run of %s failed", job.name)
+
+    async def run_once(self, job: Job) -> bool:
+        if not job.leader:
+            await self._run(job)
+            return True
+        async with engine.connect() as conn:
+            res = await conn.execute(text("select pg_try_advisory_lock(:key)"), {"key": job.lock_key})
+            if not res.scalar():
+                return False
+            try:
+                await self._run(job)
+            finally:
+                await conn.execute(text("select pg_advisory_unlock(:key)"), {"key": job.lock_key})
+        return True
+
+    async def _run(self, job: Job) -> None:
+        started = time.perf_counter()
+        try:
+            await job.func()
+        except Exception:
+            metrics.counter(f"scheduler_{job.name}_failures_total", f"Failed runs of {job.name}").inc()
+            raise
+        finally:
+            metrics.histogram(f"scheduler_{job.name}_seconds", f"Run time of {job.name}").observe(time.perf_counter() - started)
+
+    async def _loop(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(job.interval + random.uniform(0, job.jitter))
+            try:
+                await self.run_once(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("scheduled job %s failed", job.name)
+
+
+scheduler = Scheduler()
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any
+
+from ..config import settings
+from . import metrics
+
+# Payment proof states must survive a crash: writes entering or leaving them
+# go straight to tg_sessions instead of waiting for the next flush.
+DURABLE_STATES = frozenset({"pay_proof", "topup_proof"})
+
+writes_buffered = metrics.counter("session_writes_buffered_total", "Session state writes absorbed in memory")
+writes_through = metrics.counter("session_writes_through_total", "Session state writes sent straight to tg_sessions")
+rows_flushed = metrics.counter("session_rows_flushed_total", "Dirty sessions written by the batch flusher")
+rows_conflicted = metrics.counter("session_rows_conflicted_total", "Dirty sessions not flushed because tg_sessions changed underneath")
+
+
+def clear_payload(payload: dict | None) -> dict:
+    result = dict(payload or {})
+    result.pop("buy", None)
+    result.pop("connect", None)
+    return result
+
+
+def merge_payload(payload: dict | None, key: str, value: Any) -> dict:
+    result = dict(payload or {})
+    current = result.get(key)
+    if isinstance(current, dict) and isinstance(value, dict):
+        result[key] = {**current, **value}
+    else:
+        result[key] = value
+    return result
+
+
+class SessionStore:
+    """LRU of hot tg_sessions rows with write-back of dirty entries.
+
+    Each entry keeps the tg_sessions.version it was based on; the flush only
+    writes rows nobody else has changed since.
+    """
+
+    def __init__(self, capacity: int, ttl: float) -> None:
+        self._capacity = capacity
+        self._ttl = ttl
+        # tg_user_id -> (loaded_at, state, payload, version)
+        self._entries: OrderedDict[int, tuple[float, str, dict, int | None]] = OrderedDict()
+        self._dirty: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    def is_dirty(self, tg_user_id: int) -> bool:
+        return tg_user_id in self._dirty
+
+    def get(self, tg_user_id: int) -> tuple[str, dict, int | None] | None:
+        entry = self._entries.get(tg_user_id)
+        if entry is None:
+            return None
+        # clean entries go stale so edits from other replicas are picked up
+        if tg_user_id not in self._dirty and entry[0] + self._ttl < time.monotonic():
+            del self._entries[tg_user_id]
+            return None
+        self._entries.move_to_end(tg_user_id)
+        return entry[1], entry[2], entry[3]
+
+    def remember(self, tg_user_id: int, state: str, payload: dict | None, version: int | None) -> None:
+        if tg_user_id in self._dirty:
+            return
+        self._entries[tg_user_id] = (time.monotonic(), state, dict(payload or {}), version)
+        self._entries.move_to_end(tg_user_id)
+        self._evict()
+
+    def update(self, tg_user_id: int, state: str, payload: dict, version: int | None, dirty: bool = True) -> None:
+        self._entries[tg_user_id] = (time.monotonic(), state, payload, version)
+        self._entries.move_to_end(tg_user_id)
+        if dirty:
+            self._dirty.add(tg_user_id)
+        else:
+            self._dirty.discard(tg_user_id)
+        self._evict()
+
+    def forget(self, tg_user_id: int) -> None:
+        self._entries.pop(tg_user_id, None)
+        self._dirty.discard(tg_user_id)
+
+    def take_dirty(self) -> list[dict[str, Any]]:
+        rows = []
+        for tg_user_id in self._dirty:
+            entry = self._entries.get(tg_user_id)
+            if entry is not None:
+                rows.append({"tg_user_id": tg_user_id, "state": entry[1], "payload": entry[2], "version": entry[3]})
+        self._dirty.clear()
+        return rows
+
+    def restore_dirty(self, tg_user_ids: list[int]) -> None:
+        self._dirty.update(i for i in tg_user_ids if i in self._entries)
+
+    def flushed(self, tg_user_id: int, version: int | None, new_version: int) -> None:
+        # rebase on the row just written unless a write-through replaced the entry meanwhile
+        entry = self._entries.get(tg_user_id)
+        if entry is not None and entry[3] == version:
+            self._entries[tg_user_id] = (entry[0], entry[1], entry[2], new_version)
+
+    def conflicted(self, tg_user_id: int, version: int | None) -> None:
+        # the row moved on without us (write-through, another replica): the database wins
+        entry = self._entries.get(tg_user_id)
+        if entry is not None and entry[3] == version:
+            self.forget(tg_user_id)
+
+    def _evict(self) -> None:
+        # dirty entries are never dropped; they may overshoot capacity until flushed
+        overflow = len(self._entries) - self._capacity
+        if overflow <= 0:
+            return
+        for tg_user_id in list(self._entries):
+            if overflow <= 0:
+                break
+            if tg_user_id not in self._dirty:
+                del self._entries[tg_user_id]
+                overflow -= 1
+
+
+session_store = SessionStore(settings.session_store_capacity, settings.session_store_ttl)
+metrics.gauge("session_store_entries", "Sessions held in memory", lambda: len(session_store))
+metrics.gauge("session_store_dirty", "Sessions waiting for the next flush", lambda: session_store.dirty_count)
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import time
+from typing import Any
+
+from ..config import settings
+
+CHANNEL = "bot_settings_changed"
+
+
+class SettingsCache:
+    """bot_settings values keyed by setting key, dropped on TTL or NOTIFY."""
+
+    def __init__(self, ttl: float) -> None:
+        self._ttl = ttl
+        self._items: dict[str, tuple[float, Any]] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        item = self._items.get(key)
+        if item is None or item[0] < time.monotonic():
+            return default
+        return item[1]
+
+    def put(self, key: str, value: Any) -> None:
+        self._items[key] = (time.monotonic() + self._ttl, value)
+
+    def invalidate(self, key: str | None = None) -> None:
+        if key is None:
+            self._items.clear()
+        else:
+            self._items.pop(key, None)
+
+
+settings_cache = SettingsCache(settings.settings_cache_ttl)
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import codecs
+import csv
+import re
+from decimal import Decimal, InvalidOperation
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import metrics, repo
+
+# codes issued by balance.topup_amount
+CODE_RE = re.compile(r"PAY-[0-9A-F]{6}", re.IGNORECASE)
+# first header that matches wins: the settled amount beats the card-side one
+AMOUNT_HEADERS = ("сумма платежа", "сумма операции", "сумма", "amount", "credit")
+OFX_FIELD_RE = re.compile(r"<(TRNAMT|NAME|MEMO|FITID)>([^<\r\n]*)", re.IGNORECASE)
+OFX_BLOCK_LIMIT = 64 * 1024
+
+statement_rows = metrics.counter("statement_rows_total", "Bank statement rows read by the importer")
+statement_credited = metrics.counter("statement_topups_credited_total", "Top-up orders approved from bank statements")
+
+
+class StatementError(ValueError):
+    pass
+
+
+def parse_amount(raw: str | None) -> Decimal | None:
+    # "1 000,00", "1,000.00", "1.000,00": whichever of , and . comes last is the
+    # decimal point, unless it repeats ("1.000.000") or is the only separator with
+    # exactly three digits after it ("1,000": no currency here has three decimals);
+    # spaces of any kind group digits
+    value = "".join((raw or "").split()).lstrip("+")
+    point = max(value.rfind(","), value.rfind("."))
+    if point >= 0 and value.count(value[point]) > 1:
+        point = -1
+    elif point > 0 and len(value) - point - 1 == 3 and value[point + 1:].isdigit() and ("," in value) != ("." in value):
+        point = -1
+    value = value[:point].replace(",", "").replace(".", "") + "." + value[point + 1:] if point >= 0 else value.replace(",", "").replace(".", "")
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return None
+
+
+async def _decoded(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # UTF-8 if the first chunk decodes as such, otherwise the cp1251 most Russian banks export
+    decoder = None
+    async for chunk in chunks:
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder("utf-8-sig")()
+            try:
+                text = decoder.decode(chunk)
+            except UnicodeDecodeError:
+                decoder = codecs.getincrementaldecoder("cp1251")()
+                text = decoder.decode(chunk)
+            decoder.errors = "replace"
+        else:
+            text = decoder.decode(chunk)
+        if text:
+            yield text
+    if decoder is not None:
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+
+async def _lines(texts: AsyncIterator[str]) -> AsyncIterator[str]:
+    pending = ""
+    async for text in texts:
+        pending += text
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def _csv_entries(texts: AsyncIterator[str]) -> AsyncIterator[dict[str, Any]]:
+    amount_col = None
+    delimiter = ";"
+    record: list[str] = []
+    async for line in _lines(texts):
+        if amount_col is None:
+            if not line.strip():
+                continue
+            delimiter = max(";,\t", key=line.count)
+            header = [h.strip().strip('"').lower() for h in next(csv.reader([line], delimiter=delimiter))]
+            for name in AMOUNT_HEADERS:
+                if name in header:
+                    amount_col = header.index(name)
+                    break
+            else:
+                raise StatementError("no amount column")
+            continue
+        # a quoted field can span lines; wait for the closing quote
+        record.append(line)
+        if sum(part.count('"') for part in record) % 2:
+            if len(record) > 50:
+                raise StatementError("unterminated quote")
+            continue
+        row = next(csv.reader([part + "\n" for part in record], delimiter=delimiter), [])
+        record = []
+        if not any(cell.strip() for cell in row):
+            continue
+        yield {
+            "amount": parse_amount(row[amount_col]) if amount_col < len(row) else None,
+            "text": " ".join(row),
+            "ref": None,
+        }
+    if record:
+        raise StatementError("unterminated quote")
+
+
+async def _ofx_entries(texts: AsyncIterator[str]) -> AsyncIterator[dict[str, Any]]:
+    buffer = ""
+    async for text in texts:
+        buffer += text
+        while True:
+            end = buffer.upper().find("</STMTTRN>")
+            if end < 0:
+                break
+            block, buffer = buffer[:end], buffer[end + len("</STMTTRN>"):]
+            fields = {name.upper(): value.strip() for name, value in OFX_FIELD_RE.findall(block)}
+            yield {
+                "amount": parse_amount(fields.get("TRNAMT")),
+                "text": " ".join(filter(None, (fields.get("NAME"), fields.get("MEMO")))),
+                "ref": fields.get("FITID"),
+            }
+        # no transaction in sight: keep only what a split tag could need
+        if "<STMTTRN>" not in buffer.upper():
+            buffer = buffer[-16:]
+        elif len(buffer) > OFX_BLOCK_LIMIT:
+            raise StatementError("transaction block too large")
+
+
+async def read_statement(chunks: AsyncIterator[bytes], file_name: str | None = None) -> AsyncIterator[dict[str, Any]]:
+    """Statement rows as {"amount", "text", "ref"} dicts, parsed as the bytes arrive."""
+    texts = _decoded(chunks)
+    first = await anext(texts, "")
+
+    async def replay() -> AsyncIterator[str]:
+        yield first
+        async for text in texts:
+            yield text
+
+    head = first.lstrip().upper()
+    is_ofx = (file_name or "").lower().endswith((".ofx", ".qfx")) or head.startswith("OFXHEADER") or "<OFX>" in head
+    parser = _ofx_entries if is_ofx else _csv_entries
+    async for entry in parser(replay()):
+        statement_rows.inc()
+        yield entry
+
+
+async def _settle(
+    session: AsyncSession,
+    batch: list[tuple[str, dict[str, Any]]],
+    credit: Callable[[dict[str, Any]], Awaitable[Any]],
+    report: dict[str, Any],
+) -> None:
+    by_code: dict[str, list[dict[str, Any]]] = {}
+    for order in await repo.load_orders_by_code(session, sorted({code for code, _ in batch})):
+        by_code.setdefault(((order.get("meta") or {}).get("code") or "").upper(), []).append(order)
+    for code, entry in batch:
+        orders = by_code.get(code, [])
+        pending = [o for o in orders if o["status"] == "pending" and (o.get("meta") or {}).get("type") == "topup"]
+        match = next((o for o in pending if Decimal(int((o.get("meta") or {}).get("amount") or o["amount_minor"])) == entry["amount"]), None)
+        if match is not None:
+            if await credit(match) is not None:
+                match["status"] = "paid"
+                report["credited"] += 1
+                statement_credited.inc()
+            else:
+                report["settled"] += 1
+        elif pending:
+            report["mismatch"].append(code)
+        elif orders:
+            report["settled"] += 1
+        else:
+            report["unknown"].append(code)
+    await session.commit()
+
+
+async def import_statement(
+    session: AsyncSession,
+    entries: AsyncIterator[dict[str, Any]],
+    credit: Callable[[dict[str, Any]], Awaitable[Any]],
+    batch_size: int,
+) -> dict[str, Any]:
+    """Approve pending top-ups whose code and amount both match an incoming statement row.
+
+    credit(order) approves one order and returns None if someone else already
+    did; each batch is committed before the next is read.
+    """
+    report: dict[str, Any] = {"rows": 0, "incoming": 0, "coded": 0, "credited": 0, "settled": 0, "mismatch": [], "unknown": []}
+    batch: list[tuple[str, dict[str, Any]]] = []
+    try:
+        async for entry in entries:
+            report["rows"] += 1
+            if entry["amount"] is None or entry["amount"] <= 0:
+                continue
+            report["incoming"] += 1
+            found = CODE_RE.search(entry["text"])
+            if not found:
+                continue
+            report["coded"] += 1
+            batch.append((found.group(0).upper(), entry))
+            if len(batch) >= batch_size:
+                await _settle(session, batch, credit, report)
+                batch = []
+    except StatementError:
+        # rows before the malformed part still count
+        if batch:
+            await _settle(session, batch, credit, report)
+        raise
+    if batch:
+        await _settle(session, batch, credit, report)
+    return report
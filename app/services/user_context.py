@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from typing import Any
+
+from .session_store import clear_payload, merge_payload
+
+_UNSET = object()
+
+
+class UserContext:
+    """Per-update cache of load_user_with_session rows, patched on state writes."""
+
+    def __init__(self) -> None:
+        self._users: dict[int, dict[str, Any] | None] = {}
+
+    # Copies are handed out so a handler branching on the state it loaded
+    # keeps seeing that state after its own writes.
+    def get(self, tg_user_id: int, default: Any = _UNSET) -> Any:
+        if tg_user_id not in self._users:
+            return None if default is _UNSET else default
+        user = self._users[tg_user_id]
+        return dict(user) if user is not None else None
+
+    def put(self, tg_user_id: int, user: dict[str, Any] | None) -> None:
+        self._users[tg_user_id] = dict(user) if user is not None else None
+
+    def forget(self, tg_user_id: int) -> None:
+        self._users.pop(tg_user_id, None)
+
+    def apply_state_clear(self, tg_user_id: int, state: str) -> None:
+        user = self._users.get(tg_user_id)
+        if user is None:
+            return
+        user["state"] = state
+        user["payload"] = clear_payload(user.get("payload"))
+
+    def apply_state_payload(self, tg_user_id: int, state: str, key: str, value: Any) -> None:
+        user = self._users.get(tg_user_id)
+        if user is None:
+            return
+        user["state"] = state
+        user["payload"] = merge_payload(user.get("payload"), key, value)
+
+
+def get_user_context(session: Any) -> UserContext | None:
+    info = getattr(session, "info", None)
+    return info.get("user_ctx") if info is not None else None
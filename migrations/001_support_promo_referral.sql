@@ -0,0 +1,73 @@
+-- Support, promo and referral tables (formerly created on demand by repo.py).
+
+create table if not exists support_tickets (
+    id bigserial primary key,
+    user_id bigint not null references tg_users(id) on delete cascade,
+    tg_user_id bigint not null,
+    chat_id bigint not null,
+    username text,
+    status text not null default 'open',
+    user_ticket_id integer not null,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now(),
+    message_count integer not null default 0
+);
+create unique index if not exists ux_support_tickets_user_id_user_ticket_id
+on support_tickets(user_id, user_ticket_id);
+
+create table if not exists support_messages (
+    id bigserial primary key,
+    ticket_id bigint not null references support_tickets(id) on delete cascade,
+    sender text not null,
+    text text not null,
+    created_at timestamptz not null default now()
+);
+
+create table if not exists promo_codes (
+    code text primary key,
+    bonus integer not null,
+    active boolean not null default true,
+    max_uses integer,
+    used_count integer not null default 0,
+    expires_at timestamptz,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create table if not exists promo_usages (
+    id bigserial primary key,
+    user_id bigint not null references tg_users(id) on delete cascade,
+    code text not null references promo_codes(code) on delete cascade,
+    used_at timestamptz not null default now(),
+    unique(user_id, code)
+);
+
+create table if not exists referral_wallets (
+    user_id bigint primary key references tg_users(id) on delete cascade,
+    balance integer not null default 0,
+    updated_at timestamptz not null default now()
+);
+
+create table if not exists referral_pending (
+    id bigserial primary key,
+    order_id bigint not null,
+    referrer_user_id bigint not null,
+    referred_user_id bigint not null,
+    amount_minor integer not null,
+    bonus_minor integer not null,
+    percent integer not null,
+    due_at timestamptz not null,
+    created_at timestamptz not null default now()
+);
+create unique index if not exists ux_referral_pending_order_id
+on referral_pending(order_id);
+
+create table if not exists referral_withdrawals (
+    id bigserial primary key,
+    user_id bigint not null references tg_users(id) on delete cascade,
+    amount integer not null,
+    status text not null default 'pending',
+    meta jsonb,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
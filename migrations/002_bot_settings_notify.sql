@@ -0,0 +1,18 @@
+-- Broadcast bot_settings changes so every replica drops its cached copy.
+-- The payload is the changed key; app/services/settings_cache.py listens on it.
+
+create or replace function notify_bot_settings_changed() returns trigger as $$
+begin
+    if tg_op = 'DELETE' then
+        perform pg_notify('bot_settings_changed', old.key);
+    else
+        perform pg_notify('bot_settings_changed', new.key);
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists trg_bot_settings_notify on bot_settings;
+create trigger trg_bot_settings_notify
+after insert or update or delete on bot_settings
+for each row execute function notify_bot_settings_changed();
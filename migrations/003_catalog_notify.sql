@@ -0,0 +1,19 @@
+-- Broadcast plans / vpn_servers changes so every replica drops its catalog cache.
+-- The payload is the table name; app/services/catalog.py listens on it.
+
+create or replace function notify_catalog_changed() returns trigger as $$
+begin
+    perform pg_notify('catalog_changed', tg_table_name);
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists trg_plans_catalog_notify on plans;
+create trigger trg_plans_catalog_notify
+after insert or update or delete or truncate on plans
+for each statement execute function notify_catalog_changed();
+
+drop trigger if exists trg_vpn_servers_catalog_notify on vpn_servers;
+create trigger trg_vpn_servers_catalog_notify
+after insert or update or delete or truncate on vpn_servers
+for each statement execute function notify_catalog_changed();
@@ -0,0 +1,54 @@
+-- Active key count per server, kept in step by a trigger on vpn_profiles so
+-- list_servers reads O(servers) rows instead of counting every profile.
+-- app/services/jobs.py reconciles it periodically in case anything drifts.
+
+create table if not exists server_load (
+    server_id bigint primary key,
+    active_keys integer not null default 0,
+    updated_at timestamptz not null default now()
+);
+
+create or replace function track_server_load() returns trigger as $$
+declare
+    old_sid bigint;
+    new_sid bigint;
+begin
+    if tg_op in ('UPDATE', 'DELETE') and old.status = 'active' and old.revoked_at is null then
+        old_sid := old.server_id;
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') and new.status = 'active' and new.revoked_at is null then
+        new_sid := new.server_id;
+    end if;
+    if old_sid is not distinct from new_sid then
+        return null;
+    end if;
+    if old_sid is not null then
+        update server_load
+        set active_keys = active_keys - 1, updated_at = now()
+        where server_id = old_sid;
+    end if;
+    if new_sid is not null then
+        insert into server_load (server_id, active_keys)
+        values (new_sid, 1)
+        on conflict (server_id) do update
+        set active_keys = server_load.active_keys + 1, updated_at = now();
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+-- hold off profile writes so the backfill and the trigger agree
+lock table vpn_profiles in share row exclusive mode;
+
+drop trigger if exists trg_vpn_profiles_server_load on vpn_profiles;
+create trigger trg_vpn_profiles_server_load
+after insert or update of status, revoked_at, server_id or delete on vpn_profiles
+for each row execute function track_server_load();
+
+insert into server_load (server_id, active_keys)
+select server_id, count(*)
+from vpn_profiles
+where status = 'active' and revoked_at is null and server_id is not null
+group by server_id
+on conflict (server_id) do update
+set active_keys = excluded.active_keys, updated_at = now();
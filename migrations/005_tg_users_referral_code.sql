@@ -0,0 +1,23 @@
+-- Assign referral_code (REF<id>) and drop self-referrals as part of the insert
+-- itself, so upsert_user needs no follow-up UPDATEs on tg_users.
+
+create or replace function tg_users_before_insert() returns trigger as $$
+begin
+    if new.referral_code is null then
+        new.referral_code := 'REF' || new.id;
+    end if;
+    if new.referrer_id = new.id then
+        new.referrer_id := null;
+    end if;
+    return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists trg_tg_users_before_insert on tg_users;
+create trigger trg_tg_users_before_insert
+before insert on tg_users
+for each row execute function tg_users_before_insert();
+
+update tg_users
+set referral_code = 'REF' || id
+where referral_code is null;
@@ -0,0 +1,4 @@
+-- logs rows are now written in batches after the fact; keep the time the
+-- event happened instead of the time the batch landed.
+
+alter table logs add column if not exists created_at timestamptz not null default now();
@@ -0,0 +1,8 @@
+-- Proof files move to the blob store (app/services/blob_store.py); rows keep
+-- only the SHA-256. Existing file_data is moved out by
+-- `python -m app.services.migrate_proofs`, which nulls it afterwards.
+
+alter table payment_proofs add column if not exists blob_sha256 text;
+alter table payment_proofs alter column file_data drop not null;
+
+create index if not exists idx_payment_proofs_blob_sha256 on payment_proofs (blob_sha256);
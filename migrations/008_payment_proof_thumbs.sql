@@ -0,0 +1,6 @@
+-- Image proofs are re-encoded on upload: blob_sha256 then points at the
+-- normalized image, thumb_sha256 at the admin preview and original_sha256 at
+-- the untouched upload when PROOF_KEEP_ORIGINALS is on.
+
+alter table payment_proofs add column if not exists thumb_sha256 text;
+alter table payment_proofs add column if not exists original_sha256 text;
@@ -0,0 +1,23 @@
+-- One row per payment proof: the SHA-256 of the upload as received and, for
+-- images, a 64-bit dHash. The dHash is also split into four 16-bit bands;
+-- hashes within 3 bits of each other share at least one band, so a
+-- near-duplicate lookup is a few index probes instead of a scan of every proof.
+-- Older proofs are fingerprinted by `python -m app.services.proof_fingerprints`.
+
+create table if not exists payment_proof_fingerprints (
+    proof_id bigint primary key references payment_proofs (id) on delete cascade,
+    order_id bigint not null references payment_orders (id) on delete cascade,
+    sha256 text not null,
+    dhash bigint,
+    band0 integer,
+    band1 integer,
+    band2 integer,
+    band3 integer,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists idx_payment_proof_fingerprints_sha256 on payment_proof_fingerprints (sha256);
+create index if not exists idx_payment_proof_fingerprints_band0 on payment_proof_fingerprints (band0) where band0 is not null;
+create index if not exists idx_payment_proof_fingerprints_band1 on payment_proof_fingerprints (band1) where band1 is not null;
+create index if not exists idx_payment_proof_fingerprints_band2 on payment_proof_fingerprints (band2) where band2 is not null;
+create index if not exists idx_payment_proof_fingerprints_band3 on payment_proof_fingerprints (band3) where band3 is not null;
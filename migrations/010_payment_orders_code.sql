@@ -0,0 +1,4 @@
+-- Statement import (app/services/statement_import.py) looks up top-up orders
+-- by the PAY-xxxxxx code the user puts in the transfer comment.
+
+create index if not exists idx_payment_orders_meta_code on payment_orders ((meta->>'code')) where meta->>'code' is not null;
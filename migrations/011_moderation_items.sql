@@ -0,0 +1,27 @@
+-- Shared moderation queue for payment proofs. Every admin still gets a copy,
+-- but a decision first claims the order's row (FOR UPDATE SKIP LOCKED), so
+-- two admins can't act on it at once; `messages` maps admin chat_id to the
+-- copy's message_id so every copy is deleted once the item is done.
+-- status: open -> claimed -> done
+
+create table if not exists moderation_items (
+    id bigserial primary key,
+    order_id bigint not null unique references payment_orders (id) on delete cascade,
+    status text not null default 'open',
+    caption text,
+    claimed_by bigint,
+    claimed_at timestamptz,
+    messages jsonb not null default '{}'::jsonb,
+    resolution text,
+    created_at timestamptz not null default now(),
+    resolved_at timestamptz
+);
+
+create index if not exists idx_moderation_items_queue on moderation_items (id) where status <> 'done';
+
+insert into moderation_items (order_id, created_at)
+select o.id, o.created_at
+from payment_orders o
+where o.status = 'pending'
+  and exists (select 1 from payment_proofs p where p.order_id = o.id)
+on conflict (order_id) do nothing;
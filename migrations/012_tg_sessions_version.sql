@@ -0,0 +1,17 @@
+-- Buffered session writes (app/services/session_store.py) are flushed only
+-- onto the version they were read at, so a late flush can't overwrite a
+-- write-through or another replica's change. Every update bumps the version.
+
+alter table tg_sessions add column if not exists version bigint not null default 0;
+
+create or replace function tg_sessions_bump_version() returns trigger as $$
+begin
+    new.version := old.version + 1;
+    return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists trg_tg_sessions_version on tg_sessions;
+create trigger trg_tg_sessions_version
+before update on tg_sessions
+for each row execute function tg_sessions_bump_version();
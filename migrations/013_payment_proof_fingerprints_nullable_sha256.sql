@@ -0,0 +1,4 @@
+-- Backfilled fingerprints of normalized proofs whose original wasn't kept have
+-- no hash of the upload as received; they match on the dHash only.
+
+alter table payment_proof_fingerprints alter column sha256 drop not null;
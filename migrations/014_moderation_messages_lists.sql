@@ -0,0 +1,10 @@
+-- moderation_items.messages now maps admin chat_id to a list of message_ids:
+-- an admin can hold the fan-out copy and one pulled with "next", and both
+-- are deleted once the item is done.
+
+update moderation_items m
+set messages = (
+    select coalesce(jsonb_object_agg(e.key, case when jsonb_typeof(e.value) = 'array' then e.value else jsonb_build_array(e.value) end), '{}'::jsonb)
+    from jsonb_each(m.messages) e
+)
+where exists (select 1 from jsonb_each(m.messages) e where jsonb_typeof(e.value) <> 'array');
@@ -0,0 +1,41 @@
+from app.config import settings
+from app.services import outbound
+
+
+def test_prune_keeps_chat_buckets_under_cap(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(outbound.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(settings, "outbound_chat_buckets", 3)
+    scheduler = outbound.OutboundScheduler()
+    for chat_id in range(1, 21):
+        bucket = scheduler._bucket(chat_id)
+        bucket.delay(clock[0])
+        bucket.take()
+        assert len(scheduler._chats) <= 3
+
+
+
+def test_prune_drops_refilled_buckets(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(outbound.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(settings, "outbound_chat_buckets", 3)
+    scheduler = outbound.OutboundScheduler()
+    for chat_id in (1, 2, 3):
+        scheduler._bucket(chat_id).take()
+    # idle long enough for every used bucket to refill
+    clock[0] += 6
+    scheduler._bucket(4)
+    assert list(scheduler._chats) == [4]
+
+
+def test_prune_evicts_least_recently_used(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(outbound.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(settings, "outbound_chat_buckets", 4)
+    scheduler = outbound.OutboundScheduler()
+    for chat_id in (1, 2, 3, 4):
+        scheduler._bucket(chat_id).take()
+    scheduler._bucket(1)
+    scheduler._bucket(5)
+    # none refilled: 2 and 3 were used longest ago
+    assert list(scheduler._chats) == [4, 1, 5]
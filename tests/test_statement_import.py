@@ -0,0 +1,60 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+from app.services.statement_import import StatementError, parse_amount, read_statement
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("1000", Decimal("1000")),
+    ("1 000,00", Decimal("1000.00")),
+    ("1\xa0000,00", Decimal("1000.00")),
+    ("1 000,50", Decimal("1000.50")),
+    ("1,000.00", Decimal("1000.00")),
+    ("1.000,00", Decimal("1000.00")),
+    ("1.000.000", Decimal("1000000")),
+    ("+300.5", Decimal("300.5")),
+    ("1,000", Decimal("1000")),
+    ("1.000", Decimal("1000")),
+    ("-2,500", Decimal("-2500")),
+    ("1,50", Decimal("1.50")),
+    ("0,5", Decimal("0.5")),
+    ("-500,00", Decimal("-500.00")),
+    ("", None),
+    ("n/a", None),
+])
+def test_parse_amount(raw, expected):
+    assert parse_amount(raw) == expected
+
+
+async def _chunks(data: bytes, size: int = 7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def _rows(data: bytes, file_name: str | None = None):
+    return [entry async for entry in read_statement(_chunks(data), file_name)]
+
+
+def test_csv_cp1251_with_multiline_field():
+    data = (
+        'Дата;Сумма платежа;Описание\n'
+        '02.10.2026;1 000,00;"Перевод ""PAY-ABC123""\nот Ивана"\n'
+        '03.10.2026;300,00;PAY-DEF456\n'
+    ).encode("cp1251")
+    rows = asyncio.run(_rows(data))
+    assert [r["amount"] for r in rows] == [Decimal("1000.00"), Decimal("300.00")]
+    assert "PAY-ABC123" in rows[0]["text"]
+
+
+def test_csv_unterminated_quote_at_eof():
+    data = 'Дата;Сумма;Описание\n02.10.2026;100,00;"PAY-ABC123\n'.encode("utf-8")
+    with pytest.raises(StatementError):
+        asyncio.run(_rows(data))
+
+
+def test_ofx():
+    data = b"OFXHEADER:100\n<OFX><STMTTRN><TRNAMT>300.00<FITID>1<MEMO>PAY-DEF456</STMTTRN></OFX>"
+    rows = asyncio.run(_rows(data, "x.ofx"))
+    assert rows == [{"amount": Decimal("300.00"), "text": "PAY-DEF456", "ref": "1"}]